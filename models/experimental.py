@@ -1,11 +1,27 @@
-import numpy as np
+import hashlib
+import inspect
+import json
+import os
 import random
+from pathlib import Path
+
+import numpy as np
 import torch
 import torch.nn as nn
 
 from models.common import Conv, DWConv
 from utils.google_utils import attempt_download
 
+try:
+    import onnx  # for ONNX export
+except ImportError:
+    onnx = None
+
+try:
+    import onnxruntime as ort  # for ONNX-Runtime inference
+except ImportError:
+    ort = None
+
 
 class CrossConv(nn.Module):
     # Cross Convolution Downsample
@@ -157,10 +173,11 @@ class TRT_NMS(torch.autograd.Function):
 
 
 class ONNX_ORT(nn.Module):
-    '''onnx module with ONNX-Runtime NMS operation.'''
-    def __init__(self, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=640, device=None):
+    '''onnx module with ONNX-Runtime NMS operation. With nkpt, the last 3*nkpt values of every box are keypoints'''
+    def __init__(self, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=640, device=None, nkpt=None):
         super().__init__()
         self.device = device if device else torch.device("cpu")
+        self.nkpt = nkpt
         self.max_obj = torch.tensor([max_obj]).to(device)
         self.iou_threshold = torch.tensor([iou_thres]).to(device)
         self.score_threshold = torch.tensor([score_thres]).to(device)
@@ -172,7 +189,8 @@ class ONNX_ORT(nn.Module):
     def forward(self, x):
         boxes = x[:, :, :4]
         conf = x[:, :, 4:5]
-        scores = x[:, :, 5:]
+        nk = 3 * self.nkpt if self.nkpt else 0  # keypoint values
+        scores = x[:, :, 5:x.shape[2] - nk]
         scores *= conf
         boxes @= self.convert_matrix
         max_score, category_id = scores.max(2, keepdim=True)
@@ -184,8 +202,11 @@ class ONNX_ORT(nn.Module):
         selected_boxes = boxes[X, Y, :]
         selected_categories = category_id[X, Y, :].float()
         selected_scores = max_score[X, Y, :]
+        selected = [selected_boxes, selected_categories, selected_scores]
+        if nk:
+            selected.append(x[:, :, x.shape[2] - nk:][X, Y, :])  # keypoints
         X = X.unsqueeze(1).float()
-        return torch.cat([X, selected_boxes, selected_categories, selected_scores], 1)
+        return torch.cat([X] + selected, 1)
 
 class ONNX_TRT(nn.Module):
     '''onnx module with TensorRT NMS operation.'''
@@ -214,15 +235,20 @@ class ONNX_TRT(nn.Module):
 
 
 class End2End(nn.Module):
-    '''export onnx or tensorrt model with NMS operation.'''
+    '''export onnx or tensorrt model with NMS operation. Pose models keep the keypoints of the selected boxes'''
     def __init__(self, model, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=None, device=None):
         super().__init__()
         device = device if device else torch.device('cpu')
         assert isinstance(max_wh,(int)) or max_wh is None
         self.model = model.to(device)
         self.model.model[-1].end2end = True
-        self.patch_model = ONNX_TRT if max_wh is None else ONNX_ORT
-        self.end2end = self.patch_model(max_obj, iou_thres, score_thres, max_wh, device)
+        nkpt = getattr(self.model.model[-1], 'nkpt', None)  # IKeypoint head
+        if nkpt:
+            assert max_wh is not None, 'keypoints need the ONNX-Runtime NMS, pass max_wh'
+            self.end2end = ONNX_ORT(max_obj, iou_thres, score_thres, max_wh, device, nkpt=nkpt)
+        else:
+            self.patch_model = ONNX_TRT if max_wh is None else ONNX_ORT
+            self.end2end = self.patch_model(max_obj, iou_thres, score_thres, max_wh, device)
         self.end2end.eval()
 
     def forward(self, x):
@@ -240,13 +266,7 @@ def attempt_load(weights, map_location=None):
         model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
     
     # Compatibility updates
-    for m in model.modules():
-        if type(m) in [nn.Hardswish, nn.LeakyReLU, nn.ReLU, nn.ReLU6, nn.SiLU]:
-            m.inplace = True  # pytorch 1.7.0 compatibility
-        elif type(m) is nn.Upsample:
-            m.recompute_scale_factor = None  # torch 1.11.0 compatibility
-        elif type(m) is Conv:
-            m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatibility
+    compat_update(model)
     
     if len(model) == 1:
         return model[-1]  # return model
@@ -257,3 +277,180 @@ def attempt_load(weights, map_location=None):
         return model  # return ensemble
 
 
+def compat_update(model):
+    # Compatibility updates for models saved by older pytorch versions
+    for m in model.modules():
+        if type(m) in [nn.Hardswish, nn.LeakyReLU, nn.ReLU, nn.ReLU6, nn.SiLU]:
+            m.inplace = True  # pytorch 1.7.0 compatibility
+        elif type(m) is nn.Upsample:
+            m.recompute_scale_factor = None  # torch 1.11.0 compatibility
+        elif type(m) is Conv:
+            m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatibility
+
+
+deploy_version = 2  # bumped whenever fuse() folds more, so older artifacts are prepared again
+
+
+def weights_digest(weights):
+    # sha256 of the weights file. It is cached in the sidecar <weights>.sha256 with the size and modification time of
+    # the file, so the weights are only read again when they change
+    st = os.stat(weights)
+    sidecar = Path(f'{weights}.sha256')
+    try:
+        cached = json.loads(sidecar.read_text())
+        if (cached['size'], cached['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+            return cached['sha256']
+    except (OSError, ValueError, KeyError):
+        pass  # no sidecar yet, or an unreadable one
+    h = hashlib.sha256()
+    with open(weights, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    try:
+        save_atomic(lambda tmp: tmp.write_text(json.dumps({'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                                           'sha256': digest})), sidecar)
+    except OSError:
+        pass  # read-only directory, hashed again on the next start
+    return digest
+
+
+def save_atomic(write, f):
+    # Calls write(tmp) on a temporary file next to f, then moves it over f, so a crash mid-write never leaves a
+    # truncated f behind
+    f = Path(f)
+    tmp = f.with_name(f'.{f.name}.{os.getpid()}.tmp')
+    try:
+        write(tmp)
+        os.replace(tmp, f)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def deploy_path(weights, half=False, precision=None):
+    # Path of the deploy artifact of weights, keyed by the sha256 of the source weights and the deploy version.
+    # precision names the artifact, fp16 or fp32 by default
+    h = hashlib.sha256(f'deploy-v{deploy_version}:{weights_digest(weights)}'.encode())
+    w = Path(weights)
+    precision = precision or ('fp16' if half else 'fp32')
+    return w.with_name(f"{w.stem}.{h.hexdigest()[:12]}.{precision}.deploy.pt")
+
+
+def prepare_deploy(weights, half=False):
+    # Writes a deploy-ready artifact of weights: optimizer state stripped, BN fused, RepConv merged, fp32 or fp16.
+    # The source weights are left untouched. Returns the artifact path
+    attempt_download(weights)
+    f = deploy_path(weights, half)
+    if f.exists():
+        return f
+    ckpt = torch.load(weights, map_location=torch.device('cpu'))
+    with torch.no_grad():
+        model = ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval()
+    compat_update(model)
+    if half:
+        model.half()  # to FP16
+    model.requires_grad_(False)
+    save_atomic(lambda tmp: torch.save({'model': model, 'fused': True, 'half': half}, tmp), f)
+    print(f"Deploy model prepared from {weights}, saved as {f}, {os.path.getsize(f) / 1E6:.1f}MB")
+    return f
+
+
+def attempt_load_deploy(weights, map_location=None, half=False):
+    # Loads the deploy artifact of weights, preparing it on first use. The model is already fused, so unlike
+    # attempt_load() nothing is rewritten or re-fused at startup
+    f = prepare_deploy(weights, half)
+    model = torch.load(f, map_location=map_location)['model']
+    compat_update(model)
+    return model.eval()
+
+
+def export_onnx(weights, f=None, img_size=(640, 640), end2end=True, max_obj=100, iou_thres=0.45, score_thres=0.25,
+                opset=12):
+    # Exports the fused fp32 model of weights to ONNX for a fixed (height, width) input and a dynamic batch. With
+    # end2end the graph ends with the ONNX-Runtime NMS and returns (n,7+3*nkpt) rows [batch, xyxy, cls, score, kpts],
+    # otherwise the (bs,n,no) output of every anchor. names, nc, nkpt, stride and end2end are stored as metadata for
+    # attempt_load_onnx(). Returns the graph path
+    assert onnx is not None, 'onnx is required for ONNX export, pip install onnx'
+    model = attempt_load_deploy(weights, map_location=torch.device('cpu'))
+    det = model.model[-1]
+    det.conf_thres = None  # every anchor, the NMS of the graph filters them
+    det.end2end = True
+    img = torch.zeros(1, 3, *img_size)
+    model(img)  # dry run
+    net = End2End(model, max_obj, iou_thres, score_thres, max_wh=640) if end2end else model
+
+    f = str(f or Path(weights).with_suffix('.end2end.onnx' if end2end else '.onnx'))
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(net, img, f, opset_version=opset, input_names=['images'], output_names=['output'],
+                      dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'n' if end2end else 'batch'}}, **kwargs)
+
+    graph = onnx.load(f)
+    meta = {'names': json.dumps(model.names), 'nc': str(det.nc), 'nkpt': str(getattr(det, 'nkpt', 0) or 0),
+            'stride': str(int(model.stride.max())), 'end2end': str(int(end2end))}
+    for k, v in meta.items():
+        graph.metadata_props.add(key=k, value=v)
+    onnx.save(graph, f)
+    print(f"ONNX model exported from {weights}, saved as {f}, {os.path.getsize(f) / 1E6:.1f}MB")
+    return f
+
+
+class ORTModel:
+    # An ONNX graph exported by export_onnx(), run by ONNX-Runtime on the CPU and called like the torch model:
+    # model(img) returns (pred, None), pred being a (bs,n,no) tensor for non_max_suppression_kpt(). Images smaller than
+    # the fixed input of the graph are padded at the bottom and right, which leaves the coordinates unchanged. The
+    # detections centred in the padding are dropped and the others are clipped to the image. The rows of an end2end
+    # graph come back already suppressed, as xywh with the score as objectness
+    def __init__(self, f, threads=None):
+        assert ort is not None, 'onnxruntime is required for ONNX inference, pip install onnxruntime'
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(f), options, providers=['CPUExecutionProvider'])
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.names = json.loads(meta['names'])
+        self.yaml = {'nc': int(meta['nc']), 'nkpt': int(meta['nkpt'])}
+        self.stride = torch.tensor([float(meta['stride'])])
+        self.end2end = bool(int(meta['end2end']))
+        self.input = self.session.get_inputs()[0]
+        self.shape = tuple(self.input.shape[2:])  # (height, width)
+
+    def __call__(self, img):
+        x = img.float().cpu().numpy()
+        bs, _, h, w = x.shape
+        H, W = self.shape
+        assert h <= H and w <= W, f'input {h}x{w} is larger than the {H}x{W} of the ONNX graph'
+        if (h, w) != (H, W):
+            padded = np.full((bs, 3, H, W), 114 / 255, dtype=np.float32)  # letterbox grey
+            padded[:, :, :h, :w] = x
+            x = padded
+        y = self.session.run(None, {self.input.name: x})[0]
+        if not self.end2end:
+            if (h, w) != (H, W):
+                y[..., 4] *= (y[..., 0] < w) & (y[..., 1] < h)  # no objectness in the padding
+            return torch.from_numpy(y), None
+
+        if (h, w) != (H, W):
+            y = y[((y[:, 1] + y[:, 3]) / 2 < w) & ((y[:, 2] + y[:, 4]) / 2 < h)]  # box centre in the image
+            y[:, [1, 3]] = y[:, [1, 3]].clip(0, w)
+            y[:, [2, 4]] = y[:, [2, 4]].clip(0, h)
+            y[:, 7::3] = y[:, 7::3].clip(0, w)  # keypoints x
+            y[:, 8::3] = y[:, 8::3].clip(0, h)  # keypoints y
+
+        # [batch, xyxy, cls, score, kpts] rows to a (bs,n,no) prediction padded with zero rows
+        nc = self.yaml['nc']
+        b = y[:, 0].astype(np.int64)
+        counts = np.bincount(b, minlength=bs)
+        rank = np.arange(len(b)) - (np.cumsum(counts) - counts)[b]
+        pred = np.zeros((bs, max(counts.max(initial=0), 1), 5 + nc + y.shape[1] - 7), dtype=np.float32)
+        pred[b, rank, 0:2] = (y[:, 1:3] + y[:, 3:5]) / 2  # xy center
+        pred[b, rank, 2:4] = y[:, 3:5] - y[:, 1:3]  # wh
+        pred[b, rank, 4] = y[:, 6]  # score as objectness
+        pred[b, rank, 5 + y[:, 5].astype(np.int64)] = 1.0  # cls
+        pred[b, rank, 5 + nc:] = y[:, 7:]  # keypoints
+        return torch.from_numpy(pred), None
+
+
+def attempt_load_onnx(f, threads=None):
+    # Loads an ONNX graph exported by export_onnx() for ONNX-Runtime CPU inference
+    return ORTModel(f, threads)
@@ -1,6 +1,7 @@
 import argparse
 import logging
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
@@ -197,6 +198,9 @@ class IDetect(nn.Module):
 class IKeypoint(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
+    end2end = False  # inference output only, for End2End export
+    conf_thres = None  # inference: decode only the anchors with objectness above conf_thres
+    decode_cache_size = 16  # cached decode tables, see decode_tables()
 
     def __init__(self, nc=80, anchors=(), nkpt=17, ch=(), inplace=True, dw_conv_kpt=False):  # detection layer
         super(IKeypoint, self).__init__()
@@ -236,6 +240,8 @@ class IKeypoint(nn.Module):
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
+        if not self.training and self.conf_thres is not None and self.nkpt:
+            return self.forward_gated(x)
         for i in range(self.nl):
             if self.nkpt is None or self.nkpt==0:
                 x[i] = self.im[i](self.m[i](self.ia[i](x[i])))  # conv
@@ -243,51 +249,145 @@ class IKeypoint(nn.Module):
                 x[i] = torch.cat((self.im[i](self.m[i](self.ia[i](x[i]))), self.m_kpt[i](x[i])), axis=1)
 
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
-            x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
-            x_det = x[i][..., :6]
-            x_kpt = x[i][..., 6:]
+            x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2)
+            if self.training:
+                x[i] = x[i].contiguous()  # inference copies it once, in decode()
 
-            if not self.training:  # inference
+            if not self.training and not self.inplace:  # for YOLOv5 on AWS Inferentia https://github.com/ultralytics/yolov5/pull/2953
                 if self.grid[i].shape[2:4] != x[i].shape[2:4]:
                     self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-                kpt_grid_x = self.grid[i][..., 0:1]
-                kpt_grid_y = self.grid[i][..., 1:2]
-
-                if self.nkpt == 0:
-                    y = x[i].sigmoid()
-                else:
-                    y = x_det.sigmoid()
+                y = x[i].sigmoid() if self.nkpt == 0 else x[i][..., :6].sigmoid()
+                xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
+                wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                if self.nkpt != 0:
+                    y[..., 6:] = (y[..., 6:] * 2. - 0.5 + self.grid[i].repeat((1,1,1,1,self.nkpt))) * self.stride[i]  # xy
+                y = torch.cat((xy, wh, y[..., 4:]), -1)
+                z.append(y.view(bs, -1, self.no))
 
-                if self.inplace:
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i].view(1, self.na, 1, 1, 2) # wh
-                    if self.nkpt != 0:
-                        x_kpt[..., 0::3] = (x_kpt[..., ::3] * 2. - 0.5 + kpt_grid_x.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        x_kpt[..., 1::3] = (x_kpt[..., 1::3] * 2. - 0.5 + kpt_grid_y.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        #x_kpt[..., 0::3] = (x_kpt[..., ::3] + kpt_grid_x.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        #x_kpt[..., 1::3] = (x_kpt[..., 1::3] + kpt_grid_y.repeat(1,1,1,1,17)) * self.stride[i]  # xy
-                        #print('=============')
-                        #print(self.anchor_grid[i].shape)
-                        #print(self.anchor_grid[i][...,0].unsqueeze(4).shape)
-                        #print(x_kpt[..., 0::3].shape)
-                        #x_kpt[..., 0::3] = ((x_kpt[..., 0::3].tanh() * 2.) ** 3 * self.anchor_grid[i][...,0].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_x.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        #x_kpt[..., 1::3] = ((x_kpt[..., 1::3].tanh() * 2.) ** 3 * self.anchor_grid[i][...,1].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_y.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        #x_kpt[..., 0::3] = (((x_kpt[..., 0::3].sigmoid() * 4.) ** 2 - 8.) * self.anchor_grid[i][...,0].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_x.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        #x_kpt[..., 1::3] = (((x_kpt[..., 1::3].sigmoid() * 4.) ** 2 - 8.) * self.anchor_grid[i][...,1].unsqueeze(4).repeat(1,1,1,1,self.nkpt)) + kpt_grid_y.repeat(1,1,1,1,17) * self.stride[i]  # xy
-                        x_kpt[..., 2::3] = x_kpt[..., 2::3].sigmoid()
-
-                    y = torch.cat((xy, wh, y[..., 4:], x_kpt), dim = -1)
-
-                else:  # for YOLOv5 on AWS Inferentia https://github.com/ultralytics/yolov5/pull/2953
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                    if self.nkpt != 0:
-                        y[..., 6:] = (y[..., 6:] * 2. - 0.5 + self.grid[i].repeat((1,1,1,1,self.nkpt))) * self.stride[i]  # xy
-                    y = torch.cat((xy, wh, y[..., 4:]), -1)
+        if self.training:
+            return x
+        out = torch.cat(z, 1) if not self.inplace else self.decode(x)
+        return out if self.end2end else (out, x)
+
+    def decode(self, x):
+        # Decodes the inference output of all levels into one (bs,n,no) tensor. Each level is copied once into its
+        # slice of the output and decoded there in place, with the cached tables of decode_tables(): no temporaries,
+        # and x is left as it is
+        if torch.onnx.is_in_onnx_export():
+            return self.decode_export(x)
+        bs = x[0].shape[0]
+        n = [xi.shape[1] * xi.shape[2] * xi.shape[3] for xi in x]
+        out = x[0].new_empty((bs, sum(n), self.no))
+        start = 0
+        for i in range(self.nl):
+            ny, nx = x[i].shape[2:4]
+            y = out[:, start:start + n[i]].view(bs, self.na, ny, nx, self.no)
+            start += n[i]
+            y.copy_(x[i])
+            xy_offset, wh_gain, kx_offset, ky_offset, gain = self.decode_tables(i, ny, nx, y.device, y.dtype)
+
+            if self.nkpt == 0:
+                y.sigmoid_()
+            else:
+                y[..., :self.no_det].sigmoid_()
+            y[..., 0:2].mul_(gain).add_(xy_offset)  # xy
+            y[..., 2:4].pow_(2).mul_(wh_gain)  # wh
+            if self.nkpt != 0:
+                kpt = y[..., self.no_det:]
+                kpt[..., 0::3].mul_(gain).add_(kx_offset)  # xy
+                kpt[..., 1::3].mul_(gain).add_(ky_offset)  # xy
+                kpt[..., 2::3].sigmoid_()
+        return out
 
-                z.append(y.view(bs, -1, self.no))
+    def decode_export(self, x):
+        # Out of place decode() for ONNX export, the graph has no in-place updates of slices
+        z = []
+        for i in range(self.nl):
+            bs, _, ny, nx, _ = x[i].shape
+            xy_offset, wh_gain, kx_offset, ky_offset, gain = self.decode_tables(i, ny, nx, x[i].device, x[i].dtype)
+            y = x[i].sigmoid() if self.nkpt == 0 else x[i][..., :self.no_det].sigmoid()
+            xy = y[..., 0:2] * gain + xy_offset  # xy
+            wh = y[..., 2:4] ** 2 * wh_gain  # wh
+            y = [xy, wh, y[..., 4:]]
+            if self.nkpt != 0:
+                kpt = x[i][..., self.no_det:]
+                kx = kpt[..., 0::3] * gain + kx_offset  # xy
+                ky = kpt[..., 1::3] * gain + ky_offset  # xy
+                y.append(torch.stack((kx, ky, kpt[..., 2::3].sigmoid()), -1).view(bs, self.na, ny, nx, self.no_kpt))
+            z.append(torch.cat(y, -1).view(bs, -1, self.no))
+        return torch.cat(z, 1)
+
+    def decode_tables(self, i, ny, nx, device, dtype):
+        # Returns the decode tables of level i for a (ny,nx) grid, cached per (level, ny, nx, device, dtype) with LRU
+        # eviction, so alternating input resolutions do not rebuild them:
+        # xy = (sigmoid * 2 - 0.5 + grid) * stride = sigmoid * gain + xy_offset, with gain = 2 * stride
+        # wh = (sigmoid * 2) ** 2 * anchor = sigmoid ** 2 * wh_gain
+        # keypoint x, y = (raw * 2 - 0.5 + grid) * stride = raw * gain + kx_offset, ky_offset, broadcast over keypoints
+        cache = self.__dict__.setdefault('_decode_cache', OrderedDict())  # not a buffer, not saved
+        key = (i, ny, nx, device, dtype)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        stride = float(self.stride[i])
+        grid = self._make_grid(nx, ny).to(device)
+        xy_offset = ((grid - 0.5) * stride).to(dtype)  # (1,1,ny,nx,2)
+        wh_gain = (4 * self.anchor_grid[i].view(1, self.na, 1, 1, 2)).to(device, dtype)  # (1,na,1,1,2)
+        cache[key] = xy_offset, wh_gain, xy_offset[..., 0:1], xy_offset[..., 1:2], 2 * stride
+        if len(cache) > self.decode_cache_size:
+            cache.popitem(last=False)
+        return cache[key]
 
-        return x if self.training else (torch.cat(z, 1), x)
+    def fuse(self):
+        print("IKeypoint.fuse")
+        # fuse ImplicitA and ImplicitM into the output convolution of the detection branch. The keypoint branch m_kpt
+        # takes x without the implicit layers, so it is left as it is
+        with torch.no_grad():
+            for i in range(len(self.m)):
+                c2, c1, _, _ = self.m[i].weight.shape
+                self.m[i].bias += torch.matmul(self.m[i].weight.reshape(c2, c1), self.ia[i].implicit.reshape(c1))
+                self.m[i].bias *= self.im[i].implicit.reshape(c2)
+                self.m[i].weight *= self.im[i].implicit.reshape(c2, 1, 1, 1)
+
+        # the implicit layers are now no-ops, forward() and forward_gated() skip them
+        self.ia = nn.ModuleList(nn.Identity() for _ in self.m)
+        self.im = nn.ModuleList(nn.Identity() for _ in self.m)
+
+    def forward_gated(self, x):
+        # Inference with early confidence gating: the objectness of every anchor is compared with conf_thres first (as a
+        # logit, the same as sigmoid(obj) > conf_thres), and only the anchors above it are gathered and decoded.
+        # Returns a (bs,n,no) tensor of the candidates of each image, padded with zero rows (zero objectness) to the
+        # largest count n, in place of the (bs,~100k,no) output of every anchor
+        logit = math.log(self.conf_thres / (1 - self.conf_thres))
+        z, zb = [], []  # candidates and their image index
+        for i in range(self.nl):
+            x[i] = torch.cat((self.im[i](self.m[i](self.ia[i](x[i]))), self.m_kpt[i](x[i])), axis=1)
+            bs, _, ny, nx = x[i].shape
+            v = x[i].view(bs, self.na, self.no, ny, nx)
+            x[i] = v.permute(0, 1, 3, 4, 2)  # x(bs,3,20,20,85), not copied
+
+            b, a, gy, gx = (v[:, :, 4] > logit).nonzero(as_tuple=True)
+            r = v[b, a, :, gy, gx]  # (n,no) gathered candidates
+            y = r[:, :6].sigmoid()
+            g = torch.stack((gx, gy), 1).to(r.dtype)
+            xy = (y[:, 0:2] * 2. - 0.5 + g) * self.stride[i]  # xy
+            wh = (y[:, 2:4] * 2) ** 2 * self.anchor_grid[i].view(self.na, 2)[a]  # wh
+            kpt = r[:, 6:]
+            kpt[:, 0::3] = (kpt[:, 0::3] * 2. - 0.5 + g[:, 0:1]) * self.stride[i]  # xy
+            kpt[:, 1::3] = (kpt[:, 1::3] * 2. - 0.5 + g[:, 1:2]) * self.stride[i]  # xy
+            kpt[:, 2::3] = kpt[:, 2::3].sigmoid()
+            z.append(torch.cat((xy, wh, y[:, 4:], kpt), 1))
+            zb.append(b)
+
+        # pack the candidates per image, in the order of the full output
+        z, zb = torch.cat(z), torch.cat(zb)
+        k = torch.sort(zb, stable=True).indices
+        z, zb = z[k], zb[k]
+        counts = torch.bincount(zb, minlength=bs)
+        rank = torch.arange(zb.shape[0], device=zb.device) - (counts.cumsum(0) - counts)[zb]
+        out = z.new_zeros((bs, int(counts.max()) if zb.shape[0] else 0, self.no))
+        out[zb, rank] = z
+        return out, x
 
     @staticmethod
     def _make_grid(nx=20, ny=20):
@@ -621,6 +721,8 @@ class Model(nn.Module):
             elif isinstance(m, IDetect):
                 m.fuse()
                 m.forward = m.fuseforward
+            elif isinstance(m, IKeypoint) and not isinstance(m.ia[0], nn.Identity):
+                m.fuse()
         self.info()
         return self
 
@@ -1,191 +1,549 @@
 import argparse
 import collections
+import functools
+import itertools
+import json
+import multiprocessing
+import os
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import pandas as pd
+from pathlib import Path
 
 import cv2
-import imutils
 import numpy as np
 import torch
 from flask import render_template, Response, Flask
 
-from models.experimental import attempt_load
+from models.experimental import attempt_load_deploy, attempt_load_onnx, export_onnx, prepare_deploy
 from utils import frame
-from utils.frame import background_sub_frame_prep, yolo_frame_prep
-from utils.datasets import letterbox
-from utils.general import non_max_suppression_kpt, strip_optimizer
-from utils.plots import colors, plot_one_box_kpt
+from utils.background import background_model
+from utils.datasets import LoadImages, LoadStreams
+from utils.frame import FramePrep, pose_array, roi_to_frame_coords
+from utils.general import non_max_suppression_kpt
+from utils.occupancy import OccupancyLog
+from utils.pipeline import Pipeline, RateGovernor, Stage
+from utils.plots import colors, plot_one_box_kpt, plot_skeletons, pose_kpt_color, pose_limb_color, pose_skeleton
+from utils.quantize import attempt_load_int8, quantize, report
+from utils.recorder import VideoRecorder
+from utils.stream import FrameHub
+from utils.telemetry import telemetry
 from utils.torch_utils import select_device
+from utils.tracker import PoseTracker
 
 import signal
 import sys
 
+WEIGHTS = "yolov7-w6-pose.pt"
+ctrl_c_pressed = False
+
+class Camera:
+    """
+    The per-camera state of the pipeline: background subtraction reference frames, occupancy log, video recorder, pose
+    tracker and the FrameHubs of the flask streams: annotated frames, raw frames, and the pose events the page draws
+    over the raw frames.
+    """
+    def __init__(self, index, first_frame, frame_prep, governor, anonymize=False, prefix='', log_format='csv',
+                 tracker=None, lossless=False):
+        self.index = index
+        self.tracker = tracker  # a PoseTracker, or None to run the model on every motion frame
+        self.governor = governor
+        self.anonymize = anonymize
+        self.prefix = prefix  # output file name prefix, empty for a single camera
+        self.hub = FrameHub()  # annotated JPEG frames
+        self.raw_hub = FrameHub()  # JPEG frames without overlays
+        self.event_hub = FrameHub()  # server-sent pose events
+
+        # occupancy log, one row per second, written out in chunks of 5 minutes
+        self.log = OccupancyLog('output_videos', prefix=prefix, chunk_size=300, fmt=log_format)
+
+        # Frame calculations
+        self.frame_count = 0
+        self.total_fps = 0
+
+        # log rows and videos are timed on the frame timestamps, so they stay correct at any frame rate
+        self.last_sample_time = 0
+
+        # Extract resizing details based of first frame
+        self.init_background, self.init_background_grey = frame_prep.letterbox(first_frame)
+        self.resize_height, self.resize_width = self.init_background.shape[:2]
+
+        # Initialize video recorder. Videos start with the last buffer_seconds before the motion, continue for
+        # buffer_seconds after it, and are split into 30 minute pieces. Offline sources wait for the recorder instead
+        # of dropping frames
+        self.buffer_seconds = 60
+        self.recorder = VideoRecorder('output_videos', prefix, governor.max_fps,
+                                      (self.resize_width, self.resize_height),
+                                      preroll_seconds=self.buffer_seconds, postroll_seconds=self.buffer_seconds,
+                                      segment_seconds=1800, annotate=annotate_frame, block=lossless,
+                                      histogram=telemetry.histogram('pose_stage_seconds', stage='write', cam=index))
+
+        # Initialize background subtraction, starting from the first frame
+        self.background = background_model(opt.bg_model, self.init_background_grey, thresh_val=opt.thresh_val,
+                                           min_area=opt.min_area)
+
+        # Initialize counter for duration since last change
+        self.static_count = 0
+
+    def background_sub(self, packet):
+        # The background will be the current frame
+        im0 = self.init_background if self.anonymize else packet.image
+
+        # Perform background subtraction
+        with telemetry.time('background', cam=self.index):
+            is_motion, packet.motion_box, packet.motion_mask, packet.motion_area = self.background.apply(
+                packet.grey_frame, pad=opt.roi_pad, stride=64)
+        packet.processed_frame = frame.ProcessedFrame(im0, is_motion)
+        self.static_count = self.background.static_count
+
+    def log_sample(self, packet, date_time):
+        # one log row per second
+        processed_frame = packet.processed_frame
+        if packet.timestamp - self.last_sample_time >= 1:
+            with telemetry.time('log', cam=self.index):
+                self.log.append(date_time, processed_frame.get_is_motion, int(processed_frame.get_num_detections),
+                                bool(processed_frame.get_bed_occupied))
+            self.last_sample_time = packet.timestamp
+
+    def record(self, packet, jpeg=None):
+        """
+        Hands the frame to the video recorder. jpeg is the frame already encoded for the stream, if any.
+        """
+        processed_frame = packet.processed_frame
+        self.recorder.submit(packet.timestamp, processed_frame.get_frame, jpeg, processed_frame.get_is_motion,
+                             processed_frame.get_num_detections, processed_frame.get_bed_occupied, packet.rendered)
+        self.frame_count += 1
+
+    def raw_frame(self, packet):
+        """
+        Returns the frame without overlays, the first frame with --anonymize.
+        """
+        return self.init_background if self.anonymize else packet.image
+
+    def needs_frames(self, is_motion):
+        """
+        Returns whether the rendered frame has a consumer: a stream viewer, or the video file, which is open or about
+        to be opened when there is motion.
+        """
+        return self.hub.viewers > 0 or self.recorder.recording or is_motion
+
+    def finish(self):
+        finish_video_df(self.log, self.frame_count, self.recorder, self.total_fps)
+
+
+class PoseEngine:
+    """
+    Pipelined pose estimation for one or more cameras. Every capture tick flows through five stages, each served by
+    its own worker thread and joined to the next one by a bounded drop-oldest queue:
+    1) capture: reads the cameras at the rate set by the RateGovernor
+    2) preprocess: letterboxing and background subtraction, per camera
+    3) infer: the frames with motion of all cameras are batched into one YOLO model call, followed by non-max
+    suppression (single worker). With keyframe_interval, a PoseTracker per camera gives the poses track ids, and the
+    model only runs on its keyframes: on the other motion frames, the poses are moved by optical flow instead
+    4) render: plotting, text results and csv updates, per camera
+    5) encode: JPEG encoding for the flask streams, pose events for the page, and handing frames to the per camera
+    video recorder thread
+    Rendering and encoding are skipped for a camera while nothing would consume their output. The page draws the
+    overlays itself over the raw frames, so viewers alone do not make the server render.
+    Capture and encoding overlap with the model latency instead of adding to it.
+
+    cap is either a cv2.VideoCapture for a single camera or a LoadStreams for several cameras.
+    """
+    def __init__(self, cap, model, device, governor, anonymize=False, roi_infer=False, half=False, log_format='csv',
+                 keyframe_interval=None):
+        self.cap = cap
+        self.model = model
+        self.device = device
+        self.governor = governor
+        self.roi_infer = roi_infer
+        self.names = model.module.names if hasattr(model, 'module') else model.names
+        self.capture_count = 0
+
+        # Letterbox each frame once for background subtraction, the model and the renderer
+        self.frame_prep = FramePrep(device, stride=64, half=half)
+
+        self.multi = isinstance(cap, LoadStreams)
+        first_frames = [im.copy() for im in cap.imgs] if self.multi else [cap.read()[1]]
+        self.last_frames = list(cap.imgs) if self.multi else None
+        self.cameras = [Camera(i, im, self.frame_prep, governor, anonymize, prefix=f'cam{i}_' if self.multi else '',
+                               log_format=log_format, tracker=make_tracker(keyframe_interval))
+                        for i, im in enumerate(first_frames)]
+
+        self.pipeline = Pipeline([Stage('capture', self.capture, source=True),
+                                  Stage('preprocess', self.preprocess),
+                                  Stage('infer', self.infer),
+                                  Stage('render', self.render),
+                                  Stage('encode', self.encode)])
+        self.governor.watch(self.pipeline)
+
+    def read(self):
+        """
+        Returns (camera index, frame) pairs for the cameras with a new frame since the last read, or None when the
+        source has ended.
+        """
+        if not self.multi:
+            success, cap_frame = self.cap.read() if self.cap.isOpened() else (False, None)
+            return [(0, cap_frame)] if success else None
+
+        # LoadStreams replaces the frame of a stream whenever its reader thread grabs a new one
+        frames = []
+        for i, im in enumerate(list(self.cap.imgs)):
+            if im is not self.last_frames[i]:
+                self.last_frames[i] = im
+                frames.append((i, im.copy()))
+        return frames
+
+    def capture(self):
+        while True:
+            self.governor.wait()
+            if ctrl_c_pressed:
+                return None
+            with telemetry.time('capture'):
+                frames = self.read()
+            if frames is None:
+                return None
+            if frames:
+                break
+
+        self.capture_count += 1
+        start_time = time.time()
+        return [frame.FramePacket(self.capture_count, im, start_time, cam=i) for i, im in frames]
+
+    def preprocess(self, packets):
+        for packet in packets:
+            # Background subtraction and YOLO frame prep share one letterboxed frame
+            with telemetry.time('letterbox', cam=packet.cam):
+                packet.image, packet.grey_frame = self.frame_prep.letterbox(packet.cap_frame)
+            self.cameras[packet.cam].background_sub(packet)
+            telemetry.count('pose_frames_total', cam=packet.cam)
+            if packet.processed_frame.get_is_motion:
+                telemetry.count('pose_motion_frames_total', cam=packet.cam)
+
+        self.governor.update(min(c.static_count for c in self.cameras))
+        return packets
+
+    @torch.no_grad()
+    def infer(self, packets):
+        # Batch the keyframes with motion, grouped by the shape of the model input
+        batches = collections.defaultdict(list)
+        for packet in packets:
+            tracker = self.cameras[packet.cam].tracker
+            if not packet.processed_frame.get_is_motion:
+                if tracker is not None:
+                    tracker.idle()
+                continue
+            if tracker is not None:
+                packet.keyframe = tracker.schedule(packet.motion_area)
+            if packet.keyframe:
+                image = packet.image
+                if self.roi_infer:
+                    # Only the region with motion goes through the model
+                    x1, y1, x2, y2 = packet.motion_box
+                    image = np.ascontiguousarray(image[y1:y2, x1:x2])
+                batches[image.shape].append((packet, image))
+
+        for batch in batches.values():
+            # Perform YOLO. Get predictions using model. On a GPU, the time of the model call that is not spent
+            # launching it is counted in nms, which waits for its outputs
+            with telemetry.time('inference'):
+                output_data, _ = self.model(self.frame_prep.to_tensor([image for _, image in batch]))
+            telemetry.count('pose_inferences_total')
+            telemetry.count('pose_inference_frames_total', len(batch))
+            # Specifying model parameters using non-max suppression
+            with telemetry.time('nms'):
+                output_data = non_max_suppression_kpt(output_data,
+                                                      opt.yolo_conf,  # Conf. Threshold.
+                                                      0.4,  # IoU Threshold.
+                                                      nc=self.model.yaml['nc'],  # Number of classes.
+                                                      nkpt=self.model.yaml['nkpt'],  # Number of keypoints.
+                                                      kpt_label=True,
+                                                      oks_thres=opt.oks_nms,  # OKS Threshold, None for box IoU.
+                                                      oks_iou=opt.oks_iou)
+            for (packet, _), pose in zip(batch, output_data):
+                packet.output_data = [pose]
+                if self.roi_infer:
+                    roi_to_frame_coords(packet.output_data, packet.motion_box)
+
+        # Track in capture order, so the frames after a keyframe of the same batch start from its poses. Then the poses
+        # of each frame go to the host in one transfer
+        for packet in packets:
+            if not packet.processed_frame.get_is_motion:
+                continue
+            tracker = self.cameras[packet.cam].tracker
+            if tracker is not None:
+                with telemetry.time('track', cam=packet.cam):
+                    grey = cv2.cvtColor(packet.image, cv2.COLOR_BGR2GRAY)  # full size for the flow
+                    if packet.keyframe:
+                        packet.track_ids = tracker.keyframe(packet.output_data[0], grey)
+                    else:
+                        pose, packet.track_ids = tracker.propagate(grey)
+                        packet.output_data = [pose]
+            packet.poses = pose_array(packet.output_data[0], packet.track_ids)
+        return packets
+
+    def render(self, packets):
+        for packet in packets:
+            camera = self.cameras[packet.cam]
+            processed_frame = packet.processed_frame
+            is_motion = processed_frame.get_is_motion
+            date_time = datetime.fromtimestamp(packet.timestamp)
+
+            with telemetry.time('render', cam=packet.cam):
+                # Without a viewer or a recording, drawing would be discarded. Detections and occupancy are still
+                # computed
+                packet.rendered = camera.needs_frames(is_motion)
+                background = processed_frame.get_frame
+                if packet.rendered:
+                    background = overlay_motion(background, packet.motion_mask)
+                    processed_frame = frame.ProcessedFrame(background, is_motion)
+
+                if packet.poses is not None:
+                    # Place the model outputs onto a frame
+                    processed_frame = yolo_output_plotter(background, self.names, packet.poses, draw=packet.rendered)
+                packet.processed_frame = processed_frame
+
+                if packet.rendered:
+                    place_txt_results(processed_frame.get_bed_occupied, is_motion, processed_frame.get_num_detections,
+                                      processed_frame.get_frame, date_time)
+
+            camera.log_sample(packet, date_time)
+        return packets
+
+    def encode(self, packets):
+        for packet in packets:
+            camera = self.cameras[packet.cam]
+            with telemetry.time('encode', cam=packet.cam):
+                encodedImage = None  # nobody is watching
+                if packet.rendered and camera.hub.viewers > 0:
+                    (flag, encodedImage) = cv2.imencode(".jpg", packet.processed_frame.get_frame)
+                    if not flag:
+                        encodedImage = None
+
+                # the stream's JPEG bytes are reused by the pre-roll buffer
+                camera.record(packet, encodedImage)
+
+                # the page draws the overlays from the pose events over the raw frames
+                if camera.raw_hub.viewers > 0:
+                    (flag, rawImage) = cv2.imencode(".jpg", camera.raw_frame(packet))
+                    if flag:
+                        camera.raw_hub.publish(mjpeg_part(rawImage))
+                if camera.event_hub.viewers > 0:
+                    camera.event_hub.publish(b'data: ' + pose_event(packet) + b'\n\n')
+
+            # FPS calculations
+            end_time = time.time()
+            telemetry.observe('pose_latency_seconds', end_time - packet.start_time, cam=packet.cam)
+            camera.total_fps += 1 / (end_time - packet.start_time)
+            if encodedImage is None:
+                continue
+
+            camera.hub.publish(mjpeg_part(encodedImage))
+        return None
+
+    def metrics(self):
+        """
+        Returns the queue depths and drop counts of the stages and video recorders, and the capture rate, as
+        (name, type, labels, value) samples for telemetry.prometheus().
+        """
+        samples = [('pose_capture_fps', 'gauge', {}, self.governor.fps)]
+        for name, stats in self.pipeline.stats().items():
+            samples.append(('pose_queue_depth', 'gauge', {'stage': name}, stats['queue_depth']))
+            samples.append(('pose_dropped_total', 'counter', {'stage': name}, stats['dropped']))
+        for camera in self.cameras:
+            samples.append(('pose_recorder_queue_depth', 'gauge', {'cam': camera.index}, camera.recorder.queue_depth))
+            samples.append(('pose_recorder_dropped_total', 'counter', {'cam': camera.index}, camera.recorder.dropped))
+        return samples
+
+    def release(self):
+        if not self.multi:
+            self.cap.release()
+
+    def stop(self):
+        # Stops capture and processing at once, run() then closes the videos and logs
+        self.governor.stop()
+        self.pipeline.stop()
+
+    def run(self):
+        self.pipeline.start()
+        try:
+            self.pipeline.join()
+        finally:
+            self.pipeline.summary()
+            self.release()
+            for camera in self.cameras:
+                for hub in (camera.hub, camera.raw_hub, camera.event_hub):
+                    hub.close()
+                camera.finish()
+            telemetry.summary()  # once the recorders have written their queues
+
+
+class BatchEngine(PoseEngine):
+    """
+    Offline pose estimation of one recorded video or image with the stages of PoseEngine. Frames are decoded ahead by
+    the capture stage as fast as the other stages take them, batch_size frames at a time, and no frame is dropped or
+    paced. The occupancy log and the event videos are the same as for a live camera, named after the file and timed
+    on the recording clock: the file's modification time marks the end of the recording.
+    """
+    def __init__(self, path, model, device, batch_size=8, anonymize=False, roi_infer=False, half=False,
+                 log_format='csv', keyframe_interval=None):
+        self.model = model
+        self.device = device
+        self.roi_infer = roi_infer
+        self.names = model.module.names if hasattr(model, 'module') else model.names
+        self.batch_size = batch_size
+        self.capture_count = 0
+        self.frame_prep = FramePrep(device, stride=64, half=half)
+        self.multi = False
+
+        # only the decoded frames are needed, the letterbox is done by the preprocess stage
+        self.dataset = LoadImages(path, stride=64, raw=True)
+        self.frames = (im0 for _, _, im0, _ in self.dataset)  # iterates once, LoadImages.__iter__ restarts
+        if self.dataset.cap is not None:  # video
+            self.fps = self.dataset.cap.get(cv2.CAP_PROP_FPS) or opt.max_fps
+            nframes = self.dataset.nframes
+        else:
+            self.fps = opt.max_fps
+            nframes = 1
+        self.start_time = os.path.getmtime(path) - nframes / self.fps
+        self.pending = [next(self.frames)]  # the first frame is processed as well
+
+        # the videos are written at the frame rate of the recording
+        self.governor = RateGovernor(max_fps=self.fps, idle_fps=self.fps)
+        self.cameras = [Camera(0, self.pending[0], self.frame_prep, self.governor, anonymize,
+                               prefix=f'{Path(path).stem}_', log_format=log_format,
+                               tracker=make_tracker(keyframe_interval), lossless=True)]
+
+        self.pipeline = Pipeline([Stage('capture', self.capture, maxsize=4, source=True, lossless=True),
+                                  Stage('preprocess', self.preprocess, maxsize=4, lossless=True),
+                                  Stage('infer', self.infer, maxsize=4, lossless=True),
+                                  Stage('render', self.render, maxsize=4, lossless=True),
+                                  Stage('encode', self.encode, maxsize=4, lossless=True)])
+
+    def capture(self):
+        if ctrl_c_pressed:
+            return None
+        frames, self.pending = self.pending, []
+        with telemetry.time('capture'):
+            frames += itertools.islice(self.frames, self.batch_size - len(frames))
+        if not frames:
+            return None
+
+        start_time = time.time()
+        packets = []
+        for im in frames:
+            self.capture_count += 1
+            timestamp = self.start_time + (self.capture_count - 1) / self.fps
+            packets.append(frame.FramePacket(self.capture_count, im, start_time, timestamp=timestamp))
+        return packets
+
+    def release(self):
+        if self.dataset.cap is not None:
+            self.dataset.cap.release()
+
+
+@functools.lru_cache(maxsize=None)
+def load_model(device, conf_thres=None, onnx=None, int8=None):
+    """
+    Returns the fused deploy model, FP16 on GPU, with its torch device and precision. The model is loaded once per
+    process. With conf_thres, the keypoint head decodes only the anchors that can pass non-max suppression at that
+    confidence. With onnx, the exported graph at that path runs on the CPU with ONNX-Runtime instead. With int8, the
+    model quantized by --quantize for that backend runs on the CPU.
+    """
+    if onnx:
+        return attempt_load_onnx(onnx, threads=torch.get_num_threads()), torch.device('cpu'), False
+    if int8:
+        model, device, half = attempt_load_int8(WEIGHTS, backend=int8), torch.device('cpu'), False
+    else:
+        device = select_device(device)
+        half = device.type != 'cpu'
+        model = attempt_load_deploy(WEIGHTS, map_location=device, half=half)
+    model.model[-1].conf_thres = conf_thres
+    return model, device, half
+
+
+def init_batch_worker(options, threads=None):
+    """Sets the options of a batch worker process and splits the cores between the workers.
+    """
+    global opt
+    opt = options
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def process_file(path):
+    """Runs the offline pipeline on one video or image file.
+    """
+    model, device, half = load_model(opt.device, opt.yolo_conf, opt.onnx, opt.qbackend if opt.int8 else None)
+    BatchEngine(path, model, device, batch_size=opt.batch_size, anonymize=opt.anonymize, roi_infer=opt.roi_infer,
+                half=half, log_format=opt.log_format,
+                keyframe_interval=opt.keyframe_interval if opt.track else None).run()
+    return path
+
+
+def run_batch(opt):
+    """
+    Processes every video and image found at opt.source (a file, a directory or a glob) offline. With several workers
+    the files are shared out to a process pool, each process with its own model and an equal share of the cores.
+    """
+    dataset = LoadImages(opt.source)
+    files = dataset.files
+    if dataset.cap is not None:
+        dataset.cap.release()
+    if opt.workers > 1 and len(files) > 1:
+        workers = min(opt.workers, len(files))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_batch_worker, initargs=(opt, threads)) as pool:
+            for path in pool.map(process_file, files):
+                print(f'Done {path}')
+    else:
+        init_batch_worker(opt)
+        for path in files:
+            process_file(path)
+            print(f'Done {path}')
+
 
 @torch.no_grad()
-def run(lock, cap, anonymize=False, device='cpu', min_area=2000, thresh_val=40, yolo_conf=0.4,
+def run(cap, anonymize=False, device='cpu', min_area=2000, thresh_val=40, yolo_conf=0.4,
         save_conf=False, line_thickness=3, hide_labels=False, hide_conf=True):
     """
     Saves mp4 result of YOLOv7 pose model and background subtraction. Main function that reads the input video
     stream and passes parameters down to the model and other functions.
     """
-    device = select_device(opt.device)
-
-    # Load model and get class names
-    model = attempt_load("yolov7-w6-pose.pt", map_location=device)
-    _ = model.eval()
-    names = model.module.names if hasattr(model, 'module') else model.names
-
-    # initiate dataframe
-    df = pd.DataFrame(columns=['date', 'time', 'motion', 'yolo_detections', 'bed_occupied'])
-
-    # Frame calculations
-    frame_count = 0
-    total_fps = 0
-    # fps = int(cap.get(cv2.CAP_PROP_FPS))
-    fps = 3
-    starttime = time.monotonic()
-
-    # Extract resizing details based of first frame
-    init_background = letterbox(cap.read()[1], stride=64, auto=True)[0]
-    resize_height, resize_width = init_background.shape[:2]
-
-    # Initialize video writer
-    out = None
-
-    # Initialize video buffer for when there is no motion
-    buffer_seconds = 60
-    buffered_frames = collections.deque([], (fps * buffer_seconds))
-
-    # Initialize counter for duration since last change
-    static_count = 0
-
-    # Initialize background subtraction by storing first frame to compare
-    init_background_grey = background_sub_frame_prep(init_background)
-    prev_grey_frame = init_background_grey.copy()
-
-    try:
-        while cap.isOpened:
-            with lock:
-                success, cap_frame = cap.read()
-                if not success or ctrl_c_pressed:
-                    break
-
-                print("Frame {} Processing".format(frame_count + 1))
-
-                # start time for fps calculation
-                fps_start_time = time.time()
-
-                # Background subtraction and YOLO frame prep
-                curr_grey_frame = background_sub_frame_prep(cap_frame)
-                curr_frame = yolo_frame_prep(device, cap_frame)
-
-                if anonymize:
-                    im0 = init_background.copy()
-                else:
-                    # The background will be the current frame
-                    im0 = curr_frame[0].permute(1, 2, 0) * 255  # Change format [b, c, h, w] to [h, w, c]
-                    im0 = im0.cpu().numpy().astype(np.uint8)
-                    im0 = cv2.cvtColor(im0, cv2.COLOR_RGB2BGR)  # reshape image format to (BGR)
-
-                # Perform background subtraction
-                processed_frame, static_count = run_background_sub(init_background_grey, curr_grey_frame,
-                                                                   prev_grey_frame, static_count, im0)
-                is_motion = processed_frame.get_is_motion
-
-                if is_motion:
-                    # Perform YOLO. Get predictions using model
-                    with torch.no_grad():
-                        output_data, _ = model(curr_frame)
-                    # Specifying model parameters using non-max suppression
-                    output_data = non_max_suppression_kpt(output_data,
-                                                          opt.yolo_conf,  # Conf. Threshold.
-                                                          0.4,  # IoU Threshold.
-                                                          nc=model.yaml['nc'],  # Number of classes.
-                                                          nkpt=model.yaml['nkpt'],  # Number of keypoints.
-                                                          kpt_label=True)
+    model, device, half = load_model(opt.device, opt.yolo_conf, opt.onnx, opt.qbackend if opt.int8 else None)
 
-                    # Place the model outputs onto a frame
-                    processed_frame = yolo_output_plotter(processed_frame.get_frame, names, output_data)
-
-                date_time = place_txt_results(processed_frame.get_bed_occupied, is_motion,
-                                              processed_frame.get_num_detections,
-                                              processed_frame.get_frame)
-
-                update_df(processed_frame.get_bed_occupied, date_time, df, is_motion,
-                          processed_frame.get_num_detections, frame_count, fps)
-
-                # Figure out how to save the frame based off buffer
-                buffer_lst = list(buffered_frames)
-                is_motion_lst = [f.get_is_motion for f in buffer_lst]
-                curr_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-                if not any(is_motion_lst) and is_motion:
-                    out = cv2.VideoWriter(f"output_videos/{curr_time}.mp4",
-                                          cv2.VideoWriter_fourcc(*'mp4v'), fps, (resize_width, resize_height))
-                    for f in buffer_lst:
-                        out.write(f.get_frame)
-                    out.write(processed_frame.get_frame)
-                elif any(is_motion_lst) and out is not None:
-                    out.write(processed_frame.get_frame)
-                elif not any(is_motion_lst) and not is_motion and out is not None:
-                    out.release()
-
-                # backup csv file every ~5 minutes
-                if (frame_count + 1) % (300 * fps) == 0:
-                    df.to_csv(f"output_videos/backup.csv", index=False)
-                    print("Back up CSV")
-                    # break videos into 30 minute pieces
-                    if frame_count % (1800 * fps) == 0 and out is not None:
-                        out.release()
-                        out = cv2.VideoWriter(f"output_videos/{curr_time}.mp4",
-                                              cv2.VideoWriter_fourcc(*'mp4v'), fps, (resize_width, resize_height))
-                        print("Back up Video")
-
-                (flag, encodedImage) = cv2.imencode(".jpg", processed_frame.get_frame)
-                if not flag:
-                    continue
-
-                # update buffer
-                buffered_frames.append(processed_frame)
-
-                # update the previous frame
-                prev_grey_frame = curr_grey_frame
-
-                # FPS calculations
-                end_time = time.time()
-                total_fps += 1 / (end_time - fps_start_time)
-                frame_count += 1
-                time.sleep((1 / fps) - ((time.monotonic() - starttime) % (1 / fps)))
-
-            frame_bytes = b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encodedImage) + b'\r\n'
-            app.cur_frame = frame_bytes
-
-    finally:
-        finish_video_df(cap, df, frame_count, out, total_fps)
-
-
-def finish_video_df(cap, df, frame_count, out, total_fps):
-    """Releases resources and saves any running video and csv files.
+    governor = RateGovernor(max_fps=opt.max_fps, idle_fps=opt.idle_fps, idle_after=opt.idle_after)
+    engine = PoseEngine(cap, model, device, governor, anonymize, roi_infer=opt.roi_infer, half=half,
+                        log_format=opt.log_format, keyframe_interval=opt.keyframe_interval if opt.track else None)
+    app.engine = engine
+    engine.run()
+
+
+def make_tracker(keyframe_interval=None):
+    """Returns the PoseTracker of a camera, or None without tracking.
     """
-    cap.release()
-    out.release()
-    curr_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-    df.to_csv(f"output_videos/{curr_time}.csv", index=False)
-    print(f"Average FPS: {total_fps / frame_count:.3f}")
+    if keyframe_interval is None:
+        return None
+    return PoseTracker(keyframe_interval, match=opt.track_match, max_age=opt.track_age)
 
 
-def update_df(bed_occupied, date_time, df, is_motion, num_detections, frame_count, fps):
-    """Updates the dataframe df with details from the current frame
+def finish_video_df(log, frame_count, recorder, total_fps):
+    """Releases resources and writes out any running video and the rest of the occupancy log.
     """
-    if frame_count % int(fps) == 0:
-        new_row = {'date': date_time.strftime("%Y-%m-%d"), 'time': date_time.strftime("%H:%M:%S"), 'motion': is_motion,
-                   'yolo_detections': int(num_detections), 'bed_occupied': bool(bed_occupied)}
-        df.loc[len(df)] = new_row
+    recorder.close()
+    log.close()
+    print(f"Average FPS: {total_fps / max(frame_count, 1):.3f}")
 
 
-def place_txt_results(bed_occupied, is_motion, num_detections, processed_frame):
-    """Places the text of the results onto the processed frame.
+def annotate_frame(im, t, is_motion, num_detections, bed_occupied):
+    """Draws the text results of a frame captured at time t that was not rendered at the time.
+    """
+    place_txt_results(bed_occupied, is_motion, num_detections, im, datetime.fromtimestamp(t))
+
+
+def place_txt_results(bed_occupied, is_motion, num_detections, processed_frame, dt=None):
+    """Places the text of the results onto the processed frame. The timestamp is dt, or now by default.
     """
     cv2.putText(processed_frame, "Motion: {}".format(is_motion), (10, 40),
                 cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
@@ -195,152 +553,230 @@ def place_txt_results(bed_occupied, is_motion, num_detections, processed_frame):
                 cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
     # put timestamp
-    dt = datetime.now()
+    dt = dt or datetime.now()
     cv2.putText(processed_frame, dt.strftime("%Y-%m-%d %H:%M:%S"), (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
                 (255, 255, 255), 1)
 
     return dt
 
 
-def run_background_sub(background_grey, curr_grey_frame, prev_grey_frame, static_count, curr_color_frame):
-    """
-    Returns a frame with the background subtraction completed and labeled, the current grey frame to serve as the new
-    background, and the updated static counter.
-    1) computes difference in the frame from the original background and previous frame
-    2) thresholding to filter areas with significant change in pixel values
-    3) highlights the areas with motion in white
+def overlay_motion(curr_color_frame, thresh):
+    """Returns a copy of the frame with the areas with motion highlighted in white. The motion mask thresh is scaled up
+    to the frame.
     """
-    is_motion = False
-    prev_diff = False
-
-    # compute the  difference
-    frame_delta = cv2.absdiff(background_grey, curr_grey_frame)
-    prev_delta = cv2.absdiff(prev_grey_frame, curr_grey_frame)
-
-    # pixels are either 0 or 255.
-    thresh = cv2.threshold(frame_delta, opt.thresh_val, 255, cv2.THRESH_BINARY)[1]
-    prev_thresh = cv2.threshold(prev_delta, opt.thresh_val, 255, cv2.THRESH_BINARY)[1]
-
-    # find the outlines of the white parts from background
-    thresh = cv2.dilate(thresh, None, iterations=3)  # size of foreground increases
-    curr_contours = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    curr_contours = imutils.grab_contours(curr_contours)
-
-    # find outlines from previous frame
-    prev_thresh = cv2.dilate(prev_thresh, None, iterations=2)
-    prev_contours = cv2.findContours(prev_thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    prev_contours = imutils.grab_contours(prev_contours)
-
-    for c in curr_contours:
-        # Only care about contour if it's larger than the min
-        if cv2.contourArea(c) >= opt.min_area:
-            is_motion = True
-            break
-
-    for c in prev_contours:
-        if cv2.contourArea(c) >= opt.min_area:
-            prev_diff = True
-            static_count = 0
-            break
-
-    if not prev_diff:
-        static_count += 1
-
+    h, w = curr_color_frame.shape[:2]
+    if thresh.shape[:2] != (h, w):
+        thresh = cv2.resize(thresh, (w, h), interpolation=cv2.INTER_LINEAR)
     thresh_color = cv2.cvtColor(thresh, cv2.COLOR_GRAY2RGB)
-    overlay = cv2.addWeighted(curr_color_frame, 0.75, thresh_color, 0.25, 0)
-
-    overlay = frame.ProcessedFrame(overlay, is_motion)
-
-    return overlay, static_count
+    return cv2.addWeighted(curr_color_frame, 0.75, thresh_color, 0.25, 0)
 
 
-def yolo_output_plotter(background, names, output_data):
+def yolo_output_plotter(background, names, poses, draw=True):
     """
-    Plots the yolo model outputs onto background. Calculates the number of detections and places them on the background.
-    Returns the processed frame.
+    Plots the poses of one frame, a structured array of pose_dtype(), onto background. Calculates the number of
+    detections and whether anyone is on the bed. With draw=False nothing is drawn, only the detections and bed
+    occupancy are computed. Returns the processed frame.
     """
     # if there are no poses, then there is no one on the bed
-    bed_occupied = False
-    n = 0
-
-    for i, pose in enumerate(output_data):  # detections per image
-        if len(output_data) and len(pose[:, 5].unique()) != 0:  # check if no pose
-            for c in pose[:, 5].unique():  # Print results
-                n = (pose[:, 5] == c).sum()  # detections per class
-                # "YOLO detections: {}".format(n)
-
-            for det_index, (*xyxy, conf, cls) in enumerate(
-                    reversed(pose[:, :6])):  # loop over poses for drawing on frame
-                c = int(cls)  # integer class
-                keypoints = pose[det_index, 6:]
-                label = None if opt.hide_labels else (
-                    names[c] if opt.hide_conf else f'{names[c]} {conf:.2f}')
-
-                bed_occupied = plot_one_box_kpt(xyxy, background, label=label, color=colors(c, True),
-                                                line_thickness=3, kpt_label=True, kpts=keypoints, steps=3,
-                                                orig_shape=background.shape[:2])
+    n = len(poses)
+    bed_occupied = bool(plot_skeletons(background, poses['kpts'], 3, draw=draw).any())
+
+    if draw and n:
+        # labels of all poses at once, tracked poses with their id
+        labels = [None] * n
+        if not opt.hide_labels:
+            classes, ids = poses['cls'].tolist(), poses['id'].tolist()
+            labels = [names[c] if i < 0 else f'{names[c]} #{i}' for c, i in zip(classes, ids)]
+            if not opt.hide_conf:
+                labels = [f'{label} {conf:.2f}' for label, conf in zip(labels, poses['conf'].tolist())]
+
+        # lowest confidence first, so the most confident box is drawn on top
+        for box, cls, label in zip(poses['box'][::-1].tolist(), poses['cls'][::-1].tolist(), labels[::-1]):
+            plot_one_box_kpt(box, background, label=label, color=colors(cls, True), line_thickness=3)
 
     processed_frame = frame.ProcessedFrame(background, True, n, bed_occupied)
 
     return processed_frame
 
 
-def generate_frames_continuously(app):
-    """Helper function to stream frames
+def mjpeg_part(jpeg):
+    """Returns the JPEG bytes jpeg as one part of a multipart MJPEG stream.
     """
-    while True:
-        if hasattr(app, 'cur_frame'):
-            yield app.cur_frame
-        else:
-            time.sleep(0.1)
+    return b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(jpeg) + b'\r\n'
+
+
+def pose_event(packet):
+    """
+    Returns the results of a frame as compact JSON for the page to draw: the frame index, time and size, the motion
+    flag and region, the counts, and every pose with its track id (null without tracking), box, confidence and
+    keypoints, and class. Coordinates are in pixels of the letterboxed frame, keypoints are flat (x, y, confidence)
+    triplets and confidences are in percent.
+    """
+    processed_frame = packet.processed_frame
+    poses = []
+    if packet.poses is not None and len(packet.poses):
+        p, n = packet.poses, len(packet.poses)
+        kpts = p['kpts'] * np.array([1, 1, 100], dtype=np.float32)
+        poses = [{'id': i if i >= 0 else None, 'box': b, 'conf': c, 'kpts': k, 'cls': cls} for i, b, c, k, cls in
+                 zip(p['id'].tolist(), np.rint(p['box']).astype(int).tolist(),
+                     np.rint(p['conf'] * 100).astype(int).tolist(), np.rint(kpts).astype(int).reshape(n, -1).tolist(),
+                     p['cls'].tolist())]
+    h, w = packet.image.shape[:2]
+    event = {'index': packet.index, 'time': packet.timestamp, 'size': [w, h],
+             'motion': bool(processed_frame.get_is_motion), 'motion_box': packet.motion_box,
+             'detections': int(processed_frame.get_num_detections),
+             'bed_occupied': bool(processed_frame.get_bed_occupied), 'poses': poses}
+    return json.dumps(event, separators=(',', ':')).encode()
+
+
+def wait_for_engine(app):
+    # Returns the PoseEngine of app once the model is loaded
+    while getattr(app, 'engine', None) is None:
+        time.sleep(0.1)  # model still loading
+    return app.engine
+
+
+def generate_frames_continuously(app, cam=0, hub='hub'):
+    """Helper function to stream the hub of camera cam: hub, raw_hub or event_hub. Each new frame is sent once, as soon
+    as it is published.
+    """
+    if cam < len(wait_for_engine(app).cameras):
+        yield from getattr(app.engine.cameras[cam], hub).subscribe()
 
 
 def create_app():
     app = Flask(__name__)
 
     @app.route("/")
-    def index():
-        return render_template("index.html")
+    @app.route("/<int:cam>")
+    def index(cam=0):
+        # the page draws the overlays like utils.plots, colors are converted from BGR
+        names = wait_for_engine(app).names
+        return render_template("index.html", cam=cam, skeleton=pose_skeleton.tolist(),
+                               kpt_colors=pose_kpt_color[:, ::-1].tolist(),
+                               limb_colors=pose_limb_color[:, ::-1].tolist(),
+                               names=list(names), class_colors=[colors(c) for c in range(len(names))],
+                               hide_labels=opt.hide_labels, hide_conf=opt.hide_conf)
 
     @app.route("/video_feed")
-    def video_feed():
-        return Response(generate_frames_continuously(app), mimetype="multipart/x-mixed-replace; boundary=frame")
+    @app.route("/video_feed/<int:cam>")
+    def video_feed(cam=0):
+        # frames annotated by the server
+        return Response(generate_frames_continuously(app, cam), mimetype="multipart/x-mixed-replace; boundary=frame")
+
+    @app.route("/raw_feed")
+    @app.route("/raw_feed/<int:cam>")
+    def raw_feed(cam=0):
+        return Response(generate_frames_continuously(app, cam, 'raw_hub'),
+                        mimetype="multipart/x-mixed-replace; boundary=frame")
+
+    @app.route("/events")
+    @app.route("/events/<int:cam>")
+    def events(cam=0):
+        return Response(generate_frames_continuously(app, cam, 'event_hub'), mimetype="text/event-stream",
+                        headers={'Cache-Control': 'no-cache'})
+
+    @app.route("/metrics")
+    def metrics():
+        # stage latencies and counters for Prometheus
+        engine = getattr(app, 'engine', None)
+        return Response(telemetry.prometheus(engine.metrics() if engine is not None else ()),
+                        mimetype="text/plain; version=0.0.4")
 
     return app
 
 
 def parse_opt():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--source', type=str, required=True, help='0 for webcam or video path')  # video source
+    parser.add_argument('--source', type=str,
+                        help='0 for webcam, a video file or stream url, or a .txt file with one camera per line')
     parser.add_argument('--anonymize', action='store_true',
                         help="anonymize by return video with first frame as background")
     parser.add_argument('--device', type=str, default='cpu', help='cpu/0,1,2,3(gpu)')  # device arguments
+    parser.add_argument('--bg-model', default='average', choices=['first', 'average', 'mog2', 'knn'],
+                        help='background model: the first frame, a running average of the frames, or the OpenCV '
+                             'MOG2 or KNN background subtractors')
     parser.add_argument('--min-area', default=2000, type=int,
                         help='define min area in pixels that counts as motion')
     parser.add_argument('--thresh-val', default=40, type=int,
                         help='define threshold value for difference in pixels for background subtraction')
     parser.add_argument('--yolo-conf', default=0.4, type=float,
                         help='define min confidence level for YOLO model')
+    parser.add_argument('--oks-nms', default=None, type=float,
+                        help='suppress duplicate people by keypoint OKS above this value instead of box IoU')
+    parser.add_argument('--oks-iou', default=0.1, type=float,
+                        help='with --oks-nms, only compare people whose boxes overlap by more than this IoU')
+    parser.add_argument('--max-fps', default=10, type=float,
+                        help='define the highest processing rate, used while there is activity')
+    parser.add_argument('--idle-fps', default=1, type=float,
+                        help='define the processing rate used while the scene is static')
+    parser.add_argument('--idle-after', default=30, type=int,
+                        help='define the number of static frames after which the idle rate is used')
+    parser.add_argument('--roi-infer', action='store_true',
+                        help='run the YOLO model only on the region of the frame with motion')
+    parser.add_argument('--roi-pad', default=32, type=int,
+                        help='define padding in pixels around the motion region used by --roi-infer')
+    parser.add_argument('--log-format', default='csv', choices=['csv', 'parquet'],
+                        help='format of the occupancy log, parquet needs pyarrow')
     parser.add_argument('--hide-labels', default=False, action='store_true', help='hide labels')  # box hidelabel
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')  # boxhideconf
-    parser.add_argument("--ip", type=str, required=True, help="ip address of the device")
-    parser.add_argument("--port", type=int, required=True, help="ephemeral port number of the server (1024 to 65535)")
+    parser.add_argument('--batch', action='store_true',
+                        help='process the recorded videos or images at --source offline, without the flask server')
+    parser.add_argument('--batch-size', default=8, type=int,
+                        help='define the number of frames per model call with --batch')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='define the number of processes sharing the files with --batch')
+    parser.add_argument("--ip", type=str, help="ip address of the device")
+    parser.add_argument("--port", type=int, help="ephemeral port number of the server (1024 to 65535)")
+    parser.add_argument('--prepare', action='store_true',
+                        help='only write the fused deploy model for --device and exit')
+    parser.add_argument('--onnx', type=str, default=None,
+                        help='run an ONNX graph written by --export-onnx with ONNX-Runtime on the CPU')
+    parser.add_argument('--export-onnx', action='store_true',
+                        help='only write the fused model with NMS as an ONNX graph for --img-size and exit')
+    parser.add_argument('--img-size', nargs=2, type=int, default=[640, 640],
+                        help='define the fixed height and width of the ONNX graph written by --export-onnx')
+    parser.add_argument('--track', action='store_true', help='give the detected poses track ids')
+    parser.add_argument('--keyframe-interval', default=1, type=int,
+                        help='run the model on one motion frame in this many and track the poses by optical flow '
+                             'on the others, implies --track')
+    parser.add_argument('--track-match', default='iou', choices=['iou', 'oks'],
+                        help='match detections with tracks by box IoU or keypoint OKS')
+    parser.add_argument('--track-age', default=3, type=int,
+                        help='define the number of keyframes a track is kept without a matching detection')
+    parser.add_argument('--quantize', type=str, default=None,
+                        help='only calibrate an INT8 model on the recorded video or images at this path, compare it '
+                             'with the FP32 model and exit')
+    parser.add_argument('--int8', action='store_true', help='run the INT8 model written by --quantize on the CPU')
+    parser.add_argument('--qbackend', default='x86', choices=['x86', 'fbgemm', 'qnnpack', 'onednn'],
+                        help='quantized backend of --quantize and --int8, qnnpack on ARM')
     options = parser.parse_args()
+    options.track = options.track or options.keyframe_interval > 1
+    if not (options.prepare or options.export_onnx or options.quantize):
+        for arg in ('source',) if options.batch else ('source', 'ip', 'port'):
+            if getattr(options, arg) is None:
+                parser.error(f'the following arguments are required: --{arg}')
     return options
 
 
 # main function
 def main(opt, app):
-    camera = cv2.VideoCapture(int(opt.source))
-    time.sleep(5.0)  # Wait for camera to turn on
-    if not camera.isOpened():  # check if videocapture not opened
-        print('Error while trying to read video. Please check path again')
-        raise SystemExit()
-
-    lock = threading.Lock()
-    t = threading.Thread(target=run, args=[lock, camera, opt.anonymize, opt.device,
+    if opt.source.endswith('.txt'):
+        # one stream per line, all cameras share one model
+        camera = LoadStreams(opt.source, stride=64)
+    else:
+        # a camera index, or a video file or stream url opened as is
+        camera = cv2.VideoCapture(int(opt.source) if opt.source.isnumeric() else opt.source)
+        if opt.source.isnumeric():
+            time.sleep(5.0)  # Wait for camera to turn on
+        if not camera.isOpened():  # check if videocapture not opened
+            print('Error while trying to read video. Please check path again')
+            raise SystemExit()
+
+    t = threading.Thread(target=run, args=[camera, opt.anonymize, opt.device,
                                            opt.min_area, opt.thresh_val, opt.yolo_conf])
     t.daemon = True
+    app.engine_thread = t
     t.start()
 
     app.run(host=opt.ip, port=opt.port, debug=True, threaded=True, use_reloader=False)
@@ -348,17 +784,34 @@ def main(opt, app):
 
 def signal_handler(sig, frame):
     """When control-C is pressed, this function overwrites the default behavior. Update global flag to let all threads
-    know that we want to end the program. Give the program time to exit nicely.
+    know that we want to end the program, stop the engine, and wait for it to write its videos and logs before exiting.
     """
     global ctrl_c_pressed
     ctrl_c_pressed = True
-    time.sleep(2.0)
+    engine = getattr(app, 'engine', None)
+    if engine is not None:
+        engine.stop()
+    t = getattr(app, 'engine_thread', None)
+    if t is not None:
+        t.join(timeout=30)
     sys.exit(0)
 
 
 if __name__ == "__main__":
     opt = parse_opt()
-    strip_optimizer(opt.device)
+    if opt.prepare:
+        prepare_deploy(WEIGHTS, half=opt.device != 'cpu')
+        sys.exit(0)
+    if opt.export_onnx:
+        export_onnx(WEIGHTS, img_size=opt.img_size, iou_thres=0.4, score_thres=opt.yolo_conf)
+        sys.exit(0)
+    if opt.quantize:
+        _, fp32, int8, held_out = quantize(WEIGHTS, opt.quantize, backend=opt.qbackend)
+        report(fp32, int8, held_out, conf_thres=opt.yolo_conf)
+        sys.exit(0)
+    if opt.batch:
+        run_batch(opt)
+        sys.exit(0)
     app = create_app()
     ctrl_c_pressed = False
     signal.signal(signal.SIGINT, signal_handler)
@@ -0,0 +1,69 @@
+# Numerical equivalence of IKeypoint.fuse(): the fused head gives the outputs of the unfused head, run with
+# python -m pytest tests
+
+import copy
+
+import pytest
+import torch
+
+from models.yolo import IKeypoint
+
+anchors = ((19, 27, 44, 40, 38, 94), (96, 68, 86, 152, 180, 137))
+ch = (8, 16)
+
+
+@pytest.fixture
+def head():
+    torch.manual_seed(0)
+    m = IKeypoint(nc=1, anchors=anchors, nkpt=17, ch=ch)
+    m.stride = torch.tensor([8., 16.])
+    with torch.no_grad():
+        for conv, ia, im in zip(m.m, m.ia, m.im):
+            conv.bias.normal_(0, 1)
+            ia.implicit.normal_(0, 0.5)  # non-trivial, the defaults are close to identity
+            im.implicit.normal_(1, 0.5)
+    return m.eval()
+
+
+def features(bs=2):
+    torch.manual_seed(1)
+    return [torch.randn(bs, c, 32 // 2 ** i, 32 // 2 ** i) for i, c in enumerate(ch)]
+
+
+def run(m, conf_thres=None):
+    m.conf_thres = conf_thres
+    with torch.no_grad():
+        return m(features())  # forward() rewrites its input list
+
+
+def fused(m):
+    f = copy.deepcopy(m)
+    f.fuse()
+    return f
+
+
+def test_fuse_full(head):
+    out, x = run(head)
+    fout, fx = run(fused(head))
+    assert torch.allclose(out, fout, rtol=1e-4, atol=1e-4)
+    for xi, fxi in zip(x, fx):
+        assert torch.allclose(xi, fxi, rtol=1e-4, atol=1e-5)
+
+
+def test_fuse_gated(head):
+    out, _ = run(head, conf_thres=0.5)
+    fout, _ = run(fused(head), conf_thres=0.5)
+    assert out.shape[1] > 0  # some anchors pass the gate
+    assert out.shape == fout.shape
+    assert torch.allclose(out, fout, rtol=1e-4, atol=1e-4)
+
+
+def test_gated_matches_full(head):
+    # the gated candidates are the anchors of the full output above the threshold, in the same order
+    f = fused(head)
+    full, _ = run(f)
+    gated, _ = run(f, conf_thres=0.5)
+    for image, candidates in zip(full, gated):
+        expected = image[image[:, 4] > 0.5]
+        assert torch.allclose(candidates[:len(expected)], expected, rtol=1e-4, atol=1e-4)
+        assert not candidates[len(expected):].any()  # zero padding
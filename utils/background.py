@@ -0,0 +1,118 @@
+# Background models for motion detection
+
+import cv2
+import numpy as np
+
+from utils.frame import motion_roi
+
+
+class BackgroundModel:
+    """Motion detection for one camera on grayscale frames downscaled by scale, see background_sub_frame_prep(). A
+    subclass defines the foreground mask of a frame. Areas are measured with connectedComponentsWithStats and given in
+    pixels of the full frame.
+
+    A frame has motion when a connected foreground region covers at least min_area. The static count is the number
+    of frames in a row that differ from the frame before them by less than min_area.
+
+    Attributes:
+    scale: an integer representing the downscaling of the frames
+    thresh_val: an integer representing the smallest grey level difference that counts as a change
+    min_area: an integer representing the smallest region, in full frame pixels, that counts as motion
+    static_count: an integer representing the number of frames in a row without change
+    """
+    def __init__(self, first_grey, scale=4, thresh_val=40, min_area=2000):
+        self.scale = scale
+        self.thresh_val = thresh_val
+        self.min_area = min_area
+        self.static_count = 0
+        self.prev_grey = first_grey
+
+    def foreground(self, grey):
+        """
+        Returns the binary foreground mask of grey frame grey, 255 for foreground, and updates the model.
+        """
+        raise NotImplementedError
+
+    def regions(self, mask):
+        """
+        Returns the (x, y, w, h) boxes and areas of the connected regions of mask, in full frame pixels.
+        """
+        stats = cv2.connectedComponentsWithStats(mask, connectivity=8)[2][1:]  # without the background label
+        return stats[:, :4] * self.scale, stats[:, cv2.CC_STAT_AREA] * self.scale ** 2
+
+    def apply(self, grey, pad=32, stride=64):
+        """
+        Returns whether grey frame grey has motion, the padded, stride-aligned region of the full frame with motion
+        (None without motion), the downscaled foreground mask and the foreground area in full frame pixels. Updates
+        the static count.
+        """
+        mask = cv2.dilate(self.foreground(grey), None)
+        boxes, areas = self.regions(mask)
+        motion = areas >= self.min_area
+        h, w = grey.shape[:2]
+        motion_box = motion_roi(boxes[motion], (h * self.scale, w * self.scale), pad=pad, stride=stride)
+
+        # change since the previous frame
+        change = cv2.threshold(cv2.absdiff(self.prev_grey, grey), self.thresh_val, 255, cv2.THRESH_BINARY)[1]
+        self.prev_grey = grey
+        self.static_count = 0 if (self.regions(cv2.dilate(change, None))[1] >= self.min_area).any() \
+            else self.static_count + 1
+        return bool(motion.any()), motion_box, mask, int(areas.sum())
+
+
+class FirstFrameBackground(BackgroundModel):
+    # Compares every frame with the first frame
+    def __init__(self, first_grey, **kwargs):
+        super().__init__(first_grey, **kwargs)
+        self.background = first_grey
+
+    def foreground(self, grey):
+        return cv2.threshold(cv2.absdiff(self.background, grey), self.thresh_val, 255, cv2.THRESH_BINARY)[1]
+
+
+class RunningAverageBackground(BackgroundModel):
+    """Compares every frame with an exponentially weighted running average of the frames, so the reference follows
+    slow lighting changes. Background pixels are averaged in at alpha and foreground pixels at foreground_alpha, so a
+    person staying still only fades into the background slowly.
+    """
+    def __init__(self, first_grey, alpha=0.01, foreground_alpha=0.001, **kwargs):
+        super().__init__(first_grey, **kwargs)
+        self.alpha = alpha
+        self.foreground_alpha = foreground_alpha
+        self.background = first_grey.astype(np.float32)
+
+    def foreground(self, grey):
+        reference = cv2.convertScaleAbs(self.background)
+        mask = cv2.threshold(cv2.absdiff(reference, grey), self.thresh_val, 255, cv2.THRESH_BINARY)[1]
+        cv2.accumulateWeighted(grey, self.background, self.alpha, mask=cv2.bitwise_not(mask))
+        cv2.accumulateWeighted(grey, self.background, self.foreground_alpha, mask=mask)
+        return mask
+
+
+class SubtractorBackground(BackgroundModel):
+    # An OpenCV background subtractor, MOG2 or KNN. Pixels marked as shadows are not foreground
+    def __init__(self, first_grey, subtractor, **kwargs):
+        super().__init__(first_grey, **kwargs)
+        self.subtractor = subtractor
+        self.subtractor.apply(first_grey)
+
+    def foreground(self, grey):
+        return cv2.threshold(self.subtractor.apply(grey), 200, 255, cv2.THRESH_BINARY)[1]
+
+
+def background_model(name, first_grey, history=500, **kwargs):
+    """
+    Returns the background model name of a camera: 'first' for the first frame, 'average' for a running average,
+    'mog2' or 'knn' for the OpenCV background subtractors learning over history frames.
+    """
+    if name == 'first':
+        return FirstFrameBackground(first_grey, **kwargs)
+    elif name == 'average':
+        return RunningAverageBackground(first_grey, **kwargs)
+    elif name == 'mog2':
+        return SubtractorBackground(first_grey, cv2.createBackgroundSubtractorMOG2(history, detectShadows=True),
+                                    **kwargs)
+    elif name == 'knn':
+        return SubtractorBackground(first_grey, cv2.createBackgroundSubtractorKNN(history, detectShadows=True),
+                                    **kwargs)
+    raise ValueError(f'unknown background model {name}')
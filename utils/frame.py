@@ -1,7 +1,8 @@
+import functools
+
 import cv2
 import numpy as np
 import torch
-from torchvision import transforms
 
 from utils.datasets import letterbox
 
@@ -48,27 +49,154 @@ class ProcessedFrame:
         return self.bed_occupied
 
 
-def background_sub_frame_prep(frame):
+class FramePacket:
+    """A camera frame travelling through the pipeline stages, together with everything the stages compute for it.
+
+    Attributes:
+    index: an integer representing the position of the frame in the capture order
+    cam: an integer representing the index of the camera the frame comes from
+    cap_frame: the BGR frame as read from the camera
+    start_time: a float representing the time.time() at which the frame was captured
+    timestamp: a float representing the time the frame shows, start_time for a live camera or the recording time for
+    a video file. Logs and videos are timed with it
+    image: the letterboxed BGR frame shared by background subtraction, the YOLO model and the renderer
+    grey_frame: the downscaled, blurred grayscale frame used in background subtraction
+    processed_frame: a ProcessedFrame with the result of background subtraction and, later, of the YOLO model
+    motion_box: the (x1, y1, x2, y2) region of the letterboxed frame with motion, or None when there is no motion
+    motion_mask: the downscaled foreground mask of background subtraction
+    motion_area: an integer representing the foreground area in pixels of the letterboxed frame
+    output_data: the YOLO detections after non-max suppression, or the tracked poses between keyframes, or None when
+    there is no motion
+    keyframe: a boolean representing whether the model runs on the frame, False when its poses are tracked instead
+    track_ids: a tensor with the track id of every pose in output_data, or None without tracking
+    poses: output_data and track_ids on the host as one structured array of pose_dtype(), or None when there is no
+    motion
+    rendered: a boolean representing whether overlays were drawn, False when nobody would see them
+    """
+    def __init__(self, index, cap_frame, start_time, cam=0, timestamp=None):
+        self.index = index
+        self.cam = cam
+        self.cap_frame = cap_frame
+        self.start_time = start_time
+        self.timestamp = start_time if timestamp is None else timestamp
+        self.image = None
+        self.grey_frame = None
+        self.processed_frame = None
+        self.motion_box = None
+        self.motion_mask = None
+        self.motion_area = 0
+        self.output_data = None
+        self.keyframe = True
+        self.track_ids = None
+        self.poses = None
+        self.rendered = False
+
+
+class FramePrep:
+    """Prepares camera frames for background subtraction and the YOLO model. Each frame is letterboxed once, and both
+    the grayscale motion frame and the model input tensor are built from that single letterboxed buffer.
+
+    Attributes:
+    device: the torch device the model runs on
+    stride: an integer representing the stride the letterboxed shape is padded to
+    half: a boolean representing whether the model runs in FP16
+    """
+    def __init__(self, device, stride=64, half=False):
+        self.device = device
+        self.stride = stride
+        self.dtype = torch.float16 if half else torch.float32
+        self._rgb = None  # preallocated RGB buffer, (h, w, 3) uint8
+        self._input = None  # preallocated model input, (n, 3, h, w) float on device
+
+    def letterbox(self, frame):
+        """
+        Returns the letterboxed BGR frame and its downscaled, blurred grayscale version for background subtraction.
+        The BGR frame can be passed to the renderer as is.
+        """
+        image = letterbox(frame, stride=self.stride, auto=True)[0]
+        return image, background_sub_frame_prep(image)
+
+    def to_tensor(self, images):
+        """
+        Copies a batch of letterboxed BGR frames of the same shape into the preallocated model input tensor and
+        returns it. The returned tensor is overwritten by the next call.
+        """
+        n, (h, w) = len(images), images[0].shape[:2]
+        if self._input is None or self._input.shape[2:] != (h, w) or self._input.shape[0] < n:
+            self._rgb = np.empty((h, w, 3), dtype=np.uint8)
+            self._input = torch.empty((n, 3, h, w), dtype=self.dtype, device=self.device)
+        for i, image in enumerate(images):
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=self._rgb)
+            self._input[i].copy_(torch.from_numpy(self._rgb).permute(2, 0, 1))  # HWC uint8 to CHW float, one copy
+        return self._input[:n].div_(255.0)
+
+
+@functools.lru_cache(maxsize=None)
+def pose_dtype(nkpt=17):
     """
-    Prepares the frame to be used in background subtraction. The frame is converted to the same size as the YOLO
-    model frame and converted to grayscale with blur. The blurring ensures high frequency noise doesn't throw off
-    the algorithm.
+    Returns the structured dtype of one pose: its box (x1, y1, x2, y2), confidence, class, nkpt (x, y, conf) keypoint
+    rows and track id, -1 without tracking.
+    """
+    return np.dtype([('box', np.float32, 4), ('conf', np.float32), ('cls', np.int32),
+                     ('kpts', np.float32, (nkpt, 3)), ('id', np.int64)])
+
+
+def pose_array(pose, track_ids=None):
+    """
+    Returns the detections of one image after non-max suppression, a (n, 6 + 3 * nkpt) tensor on any device, as one
+    contiguous structured array of pose_dtype(). The tensor is copied to the host once, and everything after works on
+    the host without synchronizing with the device.
+    """
+    pose = pose.detach().float().cpu().numpy()  # the only transfer
+    n = len(pose)
+    poses = np.empty(n, dtype=pose_dtype((pose.shape[1] - 6) // 3))
+    poses['box'] = pose[:, :4]
+    poses['conf'] = pose[:, 4]
+    poses['cls'] = pose[:, 5]
+    poses['kpts'] = pose[:, 6:].reshape(poses['kpts'].shape)
+    poses['id'] = -1 if track_ids is None else track_ids.numpy()
+    return poses
+
+
+def background_sub_frame_prep(image, scale=4):
+    """
+    Prepares a letterboxed frame to be used in background subtraction. The frame is converted to grayscale, downscaled
+    by scale, a power of two, with an image pyramid and blurred. The blurring ensures high frequency noise doesn't throw off the
+    algorithm, and the pyramid does most of it at a fraction of the cost of a blur on the full frame.
     """
-    image = letterbox(frame, stride=64, auto=True)[0]
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (27, 27), 0)
+    for _ in range(int(scale).bit_length() - 1):
+        gray = cv2.pyrDown(gray)
+    gray = cv2.GaussianBlur(gray, (7, 7), 0)
     return gray
 
 
-def yolo_frame_prep(device, frame):
+def motion_roi(boxes, shape, pad=32, stride=64):
+    """
+    Returns the union bounding box (x1, y1, x2, y2) of the (x, y, w, h) motion region boxes, padded by pad pixels and
+    snapped outwards to multiples of the model stride so it can be fed to the model as is. The box is clipped to shape
+    (h, w). Returns None when there are no boxes.
+    """
+    if not len(boxes):
+        return None
+    boxes = np.asarray(boxes)
+    x1, y1 = boxes[:, :2].min(0) - pad
+    x2, y2 = (boxes[:, :2] + boxes[:, 2:]).max(0) + pad
+    h, w = shape[:2]
+    x1, y1 = max(x1 // stride * stride, 0), max(y1 // stride * stride, 0)
+    x2, y2 = min(-(-x2 // stride) * stride, w), min(-(-y2 // stride) * stride, h)
+    return int(x1), int(y1), int(x2), int(y2)
+
+
+def roi_to_frame_coords(output_data, motion_box):
     """
-    Prepares the frame for use in the YOLO model using the specified device.
+    Maps the YOLO detections of a cropped motion region back to the coordinates of the full letterboxed frame, in
+    place. Boxes are (x1, y1, x2, y2) in columns 0-3 and keypoints are (x, y, conf) triplets from column 6.
     """
-    orig_image = frame  # store frame
-    image = cv2.cvtColor(orig_image, cv2.COLOR_BGR2RGB)  # convert frame to RGB
-    image = letterbox(image, stride=64, auto=True)[0]
-    image = transforms.ToTensor()(image)
-    image = torch.tensor(np.array([image.numpy()]))
-    image = image.to(device)  # convert image data to device
-    image = image.float()  # convert image to float precision (cpu)
-    return image
+    x1, y1 = motion_box[:2]
+    for pose in output_data:
+        pose[:, [0, 2]] += x1
+        pose[:, [1, 3]] += y1
+        pose[:, 6::3] += x1
+        pose[:, 7::3] += y1
+    return output_data
@@ -29,6 +29,10 @@ pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ['NUMEXPR_MAX_THREADS'] = str(min(os.cpu_count(), 8))  # NumExpr max threads
 
+# COCO keypoint sigmas for OKS, in the order of the 17 pose keypoints
+kpt_oks_sigmas = torch.tensor([.26, .25, .25, .35, .35, .79, .79, .72, .72, .62, .62, 1.07, 1.07, .87, .87, .89,
+                               .89]) / 10.0
+
 
 def set_logging(rank=-1):
     logging.basicConfig(
@@ -465,6 +469,67 @@ def box_iou(box1, box2):
     return inter / (area1[:, None] + area2 - inter)  # iou = inter / (area1 + area2 - inter)
 
 
+def kpt_oks(kpt1, kpt2, area, sigmas=None, kpt_thres=0.5):
+    """
+    Return the Object Keypoint Similarity of keypoint sets, broadcast over the leading dimensions, so that
+    kpt_oks(k1[:, None], k2[None], area[:, None]) is the NxM matrix of all pairs.
+    Arguments:
+        kpt1 (Tensor[..., K*3]): reference keypoints (x, y, conf), only those with conf > kpt_thres are compared
+        kpt2 (Tensor[..., K*3])
+        area (Tensor[...]): object scale s^2, the box area of kpt1
+        sigmas (Tensor[K]): per keypoint sigmas, the COCO ones by default
+    """
+    kpt1, kpt2 = kpt1.unflatten(-1, (-1, 3)), kpt2.unflatten(-1, (-1, 3))
+    sigmas = kpt_oks_sigmas if sigmas is None else torch.as_tensor(sigmas)
+    var = (2 * sigmas.to(kpt1.device, kpt1.dtype)) ** 2
+    d = ((kpt1[..., :2] - kpt2[..., :2]) ** 2).sum(-1)  # squared distances
+    e = d / var / (area[..., None] + 1e-9) / 2
+    vis = kpt1[..., 2] > kpt_thres
+    return (torch.exp(-e) * vis).sum(-1) / vis.sum(-1).clamp(min=1)
+
+
+def oks_nms(boxes, scores, idxs, kpts, oks_thres=0.5, iou_thres=0.1, sigmas=None, chunk=1 << 20):
+    """
+    Greedy NMS that suppresses by keypoint OKS instead of box IoU, only between detections of the same idxs, like
+    torchvision.ops.batched_nms. Pairs of boxes with an IoU at or below iou_thres are never compared, which bounds the
+    OKS cost to overlapping detections. Pairs are compared in blocks of rows of about chunk pairs and
+    only the suppressing pairs are kept, so memory grows with the number of detections, not with its square.
+    Returns the indices of the kept detections, sorted by decreasing score.
+    """
+    keep = []
+    for g in idxs.unique():
+        order = torch.nonzero(idxs == g, as_tuple=True)[0]
+        order = order[scores[order].argsort(descending=True)]
+        b, kp = boxes[order], kpts[order]
+        n = order.shape[0]
+        area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+
+        # pairs (i, j) where i scores higher and suppresses j, in row-major order
+        col = torch.arange(n, device=boxes.device)
+        rows = max(1, chunk // n)
+        si, sj = [], []
+        for r in range(0, n, rows):
+            pair = (col[None] > col[r:r + rows, None]) & (box_iou(b[r:r + rows], b) > iou_thres)
+            i, j = pair.nonzero(as_tuple=True)
+            i = i + r
+            s = kpt_oks(kp[i], kp[j], area[i], sigmas) > oks_thres
+            si.append(i[s])
+            sj.append(j[s])
+        si, sj = torch.cat(si).cpu().numpy(), torch.cat(sj).cpu().numpy()
+
+        # greedy pass in score order, a suppressed detection does not suppress others
+        starts = np.searchsorted(si, np.arange(n + 1))  # pairs of i are si[starts[i]:starts[i + 1]]
+        removed = np.zeros(n, dtype=bool)
+        kept = []
+        for k in range(n):
+            if not removed[k]:
+                kept.append(k)
+                removed[sj[starts[k]:starts[k + 1]]] = True
+        keep.append(order[kept])
+    keep = torch.cat(keep) if keep else torch.zeros(0, dtype=torch.long, device=boxes.device)
+    return keep[scores[keep].argsort(descending=True)]
+
+
 def wh_iou(wh1, wh2):
     # Returns the nxm IoU matrix. wh1 is nx2, wh2 is mx2
     wh1 = wh1[:, None]  # [N,1,2]
@@ -695,101 +760,102 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def image_rank(b, bs):
+    # Returns the rank of every detection within its image and the number of detections per image, for detections
+    # sorted by their image indices b
+    counts = torch.bincount(b, minlength=bs)
+    return torch.arange(len(b), device=b.device) - (counts.cumsum(0) - counts)[b], counts
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), kpt_label=False, nc=None, nkpt=None):
-    """Runs Non-Maximum Suppression (NMS) on inference results
+                        labels=(), kpt_label=False, nc=None, nkpt=None, max_det=300, padded=False, oks_thres=None,
+                        oks_iou=0.1, sigmas=None):
+    """Runs Non-Maximum Suppression (NMS) on inference results, for the whole batch at once: one confidence mask, one
+    batched NMS call with the boxes of every image and class offset apart, and a vectorized top max_det per image
+
+    With kpt_label and oks_thres, detections are suppressed by keypoint OKS above oks_thres instead of box IoU above
+    iou_thres, see oks_nms(). oks_iou is its box IoU pre-filter and sigmas its per keypoint sigmas
 
     Returns:
-         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls] followed by the keypoints with kpt_label,
+         or with padded=True a (bs,max_det,6+) tensor of detections padded with zeros and the (bs,) detection counts
     """
     if nc is None:
         nc = prediction.shape[2] - 5  if not kpt_label else prediction.shape[2] - 56 # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
+    bs = prediction.shape[0]  # batch size
+    nk = prediction.shape[2] - 5 - nc if kpt_label else 0  # keypoint values
+    device = prediction.device
 
     # Settings
-    min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 10.0  # seconds to quit after
-    redundant = True  # require redundant detections
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.batched_nms()
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
-    t = time.time()
-    output = [torch.zeros((0,6), device=prediction.device)] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            l = labels[xi]
-            v = torch.zeros((len(l), nc + 5), device=x.device)
-            v[:, :4] = l[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:5+nc] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            if not kpt_label:
-                conf, j = x[:, 5:].max(1, keepdim=True)
-                x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-            else:
-                kpts = x[:, 6:]
-                conf, j = x[:, 5:6].max(1, keepdim=True)
-                x = torch.cat((box, conf, j.float(), kpts), 1)[conf.view(-1) > conf_thres]
-
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            print(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
-
-    return output
+    # Candidates of all images, xb is the image index of each
+    xb, xk = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    x = prediction[xb, xk]
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(l) for l in labels):
+        v, vb = [x], [xb]
+        for xi, l in enumerate(labels):
+            if len(l):
+                lv = torch.zeros((len(l), x.shape[1]), device=device, dtype=x.dtype)
+                lv[:, :4] = l[:, 1:5]  # box
+                lv[:, 4] = 1.0  # conf
+                lv[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+                v.append(lv)
+                vb.append(torch.full((len(l),), xi, device=device, dtype=xb.dtype))
+        x, xb = torch.cat(v, 0), torch.cat(vb, 0)
+
+    # Compute conf = obj_conf * cls_conf
+    scores = x[:, 5:5 + nc] * x[:, 4:5]
+
+    # Detections (box index, conf, cls), best class only or every class above the threshold
+    if multi_label:
+        i, j = (scores > conf_thres).nonzero(as_tuple=True)
+        conf = scores[i, j]
+    else:
+        conf, j = scores.max(1)
+        i = (conf > conf_thres).nonzero(as_tuple=True)[0]
+        conf, j = conf[i], j[i]
+
+    # Filter by class
+    if classes is not None:
+        k = (j[:, None] == torch.tensor(classes, device=device)).any(1)
+        i, j, conf = i[k], j[k], conf[k]
+
+    # Excess boxes, the max_nms of highest confidence of every image
+    b = xb[i]
+    if i.shape[0] > max_nms:
+        k = conf.argsort(descending=True)
+        k = k[torch.sort(b[k], stable=True).indices]  # by image, by decreasing conf within an image
+        k = k[image_rank(b[k], bs)[0] < max_nms]
+        i, j, conf, b = i[k], j[k], conf[k], b[k]
+
+    # Batched NMS, boxes of different images (and classes unless agnostic) never suppress each other
+    box = xywh2xyxy(x[i, :4])
+    group = b * nc + (0 if agnostic else j)
+    if kpt_label and oks_thres is not None:
+        k = oks_nms(box, conf, group, x[i, 5 + nc:5 + nc + nk], oks_thres, oks_iou, sigmas)
+    else:
+        k = torchvision.ops.batched_nms(box, conf, group, iou_thres)  # sorted by decreasing conf
+
+    # Limit detections, the first max_det of every image
+    k = k[torch.sort(b[k], stable=True).indices]  # by image, still by decreasing conf within an image
+    b = b[k]
+    rank, counts = image_rank(b, bs)
+    k, b, rank = k[rank < max_det], b[rank < max_det], rank[rank < max_det]
+    counts = counts.clamp(max=max_det)
+
+    # Detections matrix nx6 (xyxy, conf, cls) followed by the keypoints
+    det = torch.cat((box[k], conf[k, None], j[k, None].to(x.dtype), x[i[k], 5 + nc:5 + nc + nk]), 1)
+
+    if padded:
+        output = torch.zeros((bs, max_det, det.shape[1]), device=device, dtype=det.dtype)
+        output[b, rank] = det
+        return output, counts
+    return list(det.split(counts.tolist()))
 
 
 def strip_optimizer(device='cpu',f='yolov7-w6-pose.pt', s=''):  # from utils.general import *; strip_optimizer()
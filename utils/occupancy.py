@@ -0,0 +1,97 @@
+import os
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import pyarrow as pa  # for parquet logs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+class OccupancyLog:
+    """An append-only occupancy log. Samples are stored in preallocated typed arrays and written out every chunk_size
+    samples, or flush_seconds after the last write, so the cost of a sample does not grow with the uptime and a crash
+    loses at most one chunk or flush_seconds of samples. close() writes the rest.
+
+    With fmt='csv' each chunk is appended to one csv file per day, <prefix>occupancy-<date>.csv. With fmt='parquet'
+    each chunk is a new file in a directory per day, <prefix>occupancy/date=<date>/part-<time>-<id>.parquet, which
+    pyarrow and pandas read back as one dataset partitioned by day. The file names are unique across restarts and
+    processes, so no part overwrites another.
+
+    Attributes:
+    directory: the directory the log is written to
+    prefix: a string prepended to the file names
+    chunk_size: an integer representing the number of samples per write
+    flush_seconds: a float representing the longest time in seconds samples are kept in memory
+    fmt: 'csv' or 'parquet'
+    """
+    columns = ['date', 'time', 'motion', 'yolo_detections', 'bed_occupied']
+
+    def __init__(self, directory='output_videos', prefix='', chunk_size=300, fmt='csv', flush_seconds=60):
+        assert fmt in ('csv', 'parquet'), f'unknown log format {fmt}'
+        assert fmt != 'parquet' or pa is not None, 'pyarrow is required for parquet logs, pip install pyarrow'
+        self.directory = directory
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.flush_seconds = flush_seconds
+        self.fmt = fmt
+        self.count = 0  # samples in the current chunk
+        self.parts = 0  # parquet files written
+        self.flushed = time.monotonic()  # time of the last write
+        self.timestamp = np.empty(chunk_size, dtype=np.float64)
+        self.motion = np.empty(chunk_size, dtype=bool)
+        self.yolo_detections = np.empty(chunk_size, dtype=np.int32)
+        self.bed_occupied = np.empty(chunk_size, dtype=bool)
+
+    def append(self, date_time, is_motion, num_detections, bed_occupied):
+        i = self.count
+        self.timestamp[i] = date_time.timestamp()
+        self.motion[i] = is_motion
+        self.yolo_detections[i] = num_detections
+        self.bed_occupied[i] = bed_occupied
+        self.count += 1
+        if self.count == self.chunk_size or time.monotonic() - self.flushed >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the samples of the current chunk, split by day.
+        """
+        n, self.count = self.count, 0
+        self.flushed = time.monotonic()
+        if not n:
+            return
+        stamps = [datetime.fromtimestamp(t) for t in self.timestamp[:n]]
+        dates = np.array([t.strftime("%Y-%m-%d") for t in stamps])
+        times = np.array([t.strftime("%H:%M:%S") for t in stamps])
+        for date in dict.fromkeys(dates):  # days in order
+            i = dates == date
+            chunk = {'date': dates[i], 'time': times[i], 'motion': self.motion[:n][i],
+                     'yolo_detections': self.yolo_detections[:n][i], 'bed_occupied': self.bed_occupied[:n][i]}
+            if self.fmt == 'csv':
+                self._write_csv(date, chunk)
+            else:
+                self._write_parquet(date, chunk)
+
+    def _write_csv(self, date, chunk):
+        path = os.path.join(self.directory, f'{self.prefix}occupancy-{date}.csv')
+        header = not os.path.exists(path)
+        with open(path, 'a') as f:
+            if header:
+                f.write(','.join(self.columns) + '\n')
+            f.writelines(f'{d},{t},{m},{y},{b}\n' for d, t, m, y, b in zip(*(chunk[c] for c in self.columns)))
+
+    def _write_parquet(self, date, chunk):
+        directory = os.path.join(self.directory, f'{self.prefix}occupancy', f'date={date}')
+        os.makedirs(directory, exist_ok=True)
+        del chunk['date']  # stored in the partition directory name
+        name = f'part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet'  # sorts by time, unique across restarts
+        pq.write_table(pa.table(chunk), os.path.join(directory, name))
+        self.parts += 1
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,274 @@
+import collections
+import threading
+import time
+import traceback
+
+
+class DropOldestQueue:
+    """A bounded FIFO queue that joins two pipeline stages. When the queue is full, the oldest item is discarded so
+    the producer never blocks on a slow consumer.
+
+    Attributes:
+    maxsize: an integer representing the maximum number of items held by the queue
+    dropped: an integer counting the items that were discarded because the consumer could not keep up
+    closed: a boolean representing whether the producer has finished, or the pipeline was aborted
+    """
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            if self.closed:
+                return  # aborted, nobody reads any more
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self):
+        """
+        Blocks until an item is available and returns it. Returns None once the queue is closed and drained.
+        """
+        with self._cond:
+            while not self._items and not self.closed:
+                self._cond.wait()
+            return self._items.popleft() if self._items else None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """
+        Closes the queue and discards its items, so the consumer stops at once and the producer never waits.
+        """
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class BlockingQueue(DropOldestQueue):
+    """A bounded FIFO queue whose producer waits for room instead of discarding items. Used for offline sources,
+    where every frame has to be processed and the slowest stage sets the pace.
+    """
+    def put(self, item):
+        with self._cond:
+            while len(self._items) >= self.maxsize and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return  # aborted, nobody reads any more
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while not self._items and not self.closed:
+                self._cond.wait()
+            item = self._items.popleft() if self._items else None
+            self._cond.notify_all()  # room for the producer
+            return item
+
+
+class Stage:
+    """A pipeline stage served by a single worker thread. The worker takes items from its inbox, applies fn and
+    forwards the result to the next stage. Returning None from fn consumes the item without forwarding it.
+
+    A stage without an inbox is a source: fn is called without arguments until it returns None. A lossless stage has
+    a BlockingQueue inbox, so its producer waits instead of dropping items. When fn raises, the traceback is printed
+    and the whole pipeline is stopped.
+
+    Attributes:
+    name: a string naming the stage in the statistics
+    fn: the callable applied to every item
+    inbox: the DropOldestQueue feeding this stage, or None for a source stage
+    outbox: the DropOldestQueue of the next stage, or None for the last stage
+    processed: an integer counting the items handled by fn
+    busy_time: a float representing the total seconds spent inside fn
+    """
+    def __init__(self, name, fn, maxsize=2, source=False, lossless=False):
+        self.name = name
+        self.fn = fn
+        self.inbox = None if source else (BlockingQueue if lossless else DropOldestQueue)(maxsize)
+        self.outbox = None
+        self.processed = 0
+        self.busy_time = 0.0
+        self.pipeline = None
+        self._thread = threading.Thread(target=self._work, name=f'stage-{name}', daemon=True)
+
+    def _work(self):
+        try:
+            while True:
+                if self.inbox is None:
+                    if self.pipeline is not None and self.pipeline.stopped:
+                        break
+                    t = time.monotonic()
+                    item = self.fn()
+                    if item is None:
+                        break
+                else:
+                    item = self.inbox.get()
+                    if item is None:
+                        break
+                    t = time.monotonic()
+                    item = self.fn(item)
+                self.busy_time += time.monotonic() - t
+                self.processed += 1
+                if item is not None and self.outbox is not None:
+                    self.outbox.put(item)
+        except Exception as e:
+            traceback.print_exc()
+            if self.pipeline is not None:
+                self.pipeline.stop(self, e)
+            else:
+                raise
+        finally:
+            # let the downstream stages drain and stop
+            if self.outbox is not None:
+                self.outbox.close()
+
+    @property
+    def dropped(self):
+        return self.inbox.dropped if self.inbox is not None else 0
+
+
+class Pipeline:
+    """A chain of stages joined by bounded drop-oldest queues. Each stage runs in its own thread, so a slow stage
+    (usually inference) overlaps with the others instead of capping the whole frame rate.
+
+    Attributes:
+    stages: the list of stages, the source first
+    stopped: a boolean representing whether stop() was called
+    error: the exception that stopped the pipeline, or None
+    failed: the name of the stage that raised error, or None
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        self.stopped = False
+        self.error = None
+        self.failed = None
+        for s in stages:
+            s.pipeline = self
+        for prev, nxt in zip(stages[:-1], stages[1:]):
+            prev.outbox = nxt.inbox
+
+    def start(self):
+        for s in self.stages:
+            s._thread.start()
+        return self
+
+    def join(self):
+        """
+        Waits for every stage to finish. Raises a RuntimeError from the exception of the first stage that failed.
+        """
+        for s in self.stages:
+            s._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f'pipeline stage {self.failed} failed') from self.error
+
+    def stop(self, stage=None, error=None):
+        """
+        Stops every stage, on request or after stage failed with error: the source stops before its next item and the
+        inboxes are closed and emptied, so no stage waits on another. The items in flight are discarded.
+        """
+        if error is not None and self.error is None:
+            self.error, self.failed = error, stage.name
+        self.stopped = True
+        for s in self.stages:
+            if s.inbox is not None:
+                s.inbox.abort()
+
+    def stats(self):
+        """
+        Returns per-stage statistics. dropped is the backpressure counter: the number of items discarded at the
+        stage's inbox because the stage was still busy with earlier items.
+        """
+        return {s.name: {'processed': s.processed,
+                         'dropped': s.dropped,
+                         'queue_depth': len(s.inbox) if s.inbox is not None else 0,
+                         'busy_time': s.busy_time} for s in self.stages}
+
+    def summary(self):
+        print(f"{'stage':>12}{'processed':>12}{'dropped':>10}{'ms/item':>10}")
+        for name, s in self.stats().items():
+            ms = 1000 * s['busy_time'] / max(s['processed'], 1)
+            print(f"{name:>12}{s['processed']:>12}{s['dropped']:>10}{ms:>10.1f}")
+
+
+class RateGovernor:
+    """Paces the capture stage. While there is activity, the rate follows the throughput of the slowest stage over
+    the last window frames, up to max_fps, so fast hosts use their headroom and slow hosts are not flooded with frames
+    they would drop. Since the stages overlap, several frames are in flight at that rate. Once the scene has been
+    static for more than idle_after frames, the rate falls back to idle_fps.
+
+    Attributes:
+    max_fps: a float representing the highest capture rate
+    idle_fps: a float representing the capture rate used while the scene is static
+    idle_after: an integer representing the static frame count after which the governor idles
+    fps: a float representing the current target capture rate
+    """
+    def __init__(self, max_fps=10, idle_fps=1, idle_after=30, window=10):
+        self.max_fps = max_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.fps = max_fps
+        self.idle = False
+        self.stopped = threading.Event()  # set by stop(), ends any wait
+        self.stages = []
+        self.snapshots = collections.deque([], window + 1)  # (busy_time, processed) of the stages per update
+        self._deadline = None
+
+    def watch(self, pipeline):
+        """
+        Paces on the throughput of the stages of pipeline that have an inbox. The source is left out, its busy time
+        includes the waits of the governor.
+        """
+        self.stages = [s for s in pipeline.stages if s.inbox is not None]
+
+    def item_time(self):
+        """
+        Returns the seconds per item of the slowest watched stage over the window, or None before any item.
+        """
+        self.snapshots.append([(s.busy_time, s.processed) for s in self.stages])
+        first, last = self.snapshots[0], self.snapshots[-1]
+        times = [(b1 - b0) / (n1 - n0) for (b0, n0), (b1, n1) in zip(first, last) if n1 > n0]
+        return max(times) if times else None
+
+    def update(self, static_count):
+        """
+        Updates the activity state from the static frame count of background subtraction.
+        """
+        self.idle = static_count > self.idle_after
+        self._retarget()
+
+    def _retarget(self):
+        item_time = self.item_time()
+        if self.idle:
+            self.fps = self.idle_fps
+        elif item_time is not None:
+            self.fps = max(min(self.max_fps, 1 / max(item_time, 1e-3)), self.idle_fps)
+        else:
+            self.fps = self.max_fps
+
+    def wait(self):
+        """
+        Sleeps until the next frame is due at the current target rate, or until stop() is called.
+        """
+        now = time.monotonic()
+        if self._deadline is None or self._deadline < now:
+            self._deadline = now  # fell behind, do not try to catch up
+        else:
+            self.stopped.wait(self._deadline - now)
+        self._deadline += 1 / self.fps
+
+    def stop(self):
+        self.stopped.set()
@@ -478,54 +478,62 @@ def output_to_keypoint(output):
     return np.array(targets)
 
 
-def plot_skeleton_kpts(im, kpts, steps, orig_shape=None):
-    #Plot the skeleton and keypointsfor coco datatset
-    palette = np.array([[255, 128, 0], [255, 153, 51], [255, 178, 102],
-                        [230, 230, 0], [255, 153, 255], [153, 204, 255],
-                        [255, 102, 255], [255, 51, 255], [102, 178, 255],
-                        [51, 153, 255], [255, 153, 153], [255, 102, 102],
-                        [255, 51, 51], [153, 255, 153], [102, 255, 102],
-                        [51, 255, 51], [0, 255, 0], [0, 0, 255], [255, 0, 0],
-                        [255, 255, 255]])
-
-    skeleton = [[16, 14], [14, 12], [17, 15], [15, 13], [12, 13], [6, 12],
-                [7, 13], [6, 7], [6, 8], [7, 9], [8, 10], [9, 11], [2, 3],
-                [1, 2], [1, 3], [2, 4], [3, 5], [4, 6], [5, 7]]
-
-    pose_limb_color = palette[[9, 9, 9, 9, 7, 7, 7, 0, 0, 0, 0, 0, 16, 16, 16, 16, 16, 16, 16]]
-    pose_kpt_color = palette[[16, 16, 16, 16, 16, 0, 0, 0, 0, 0, 0, 9, 9, 9, 9, 9, 9]]
-    radius = 3
-    num_kpts = len(kpts) // steps
-
-    head_y_coord, foot_y_coord = 0, 640
-    for kid in range(num_kpts):
-        r, g, b = pose_kpt_color[kid]
-        x_coord, y_coord = kpts[steps * kid], kpts[steps * kid + 1]
-        if not (x_coord % 640 == 0 or y_coord % 640 == 0):
-            if steps == 3:
-                conf = kpts[steps * kid + 2]
-                if conf < 0.5:
-                    continue
-            cv2.circle(im, (int(x_coord), int(y_coord)), radius, (int(r), int(g), int(b)), -1)
-
-            if (0 <= kid <= 6) and y_coord > head_y_coord:
-                head_y_coord = y_coord
-            elif ((num_kpts - 6) <= kid <= num_kpts) and y_coord < foot_y_coord:
-                foot_y_coord = y_coord
-
-    for sk_id, sk in enumerate(skeleton):
-        r, g, b = pose_limb_color[sk_id]
-        pos1 = (int(kpts[(sk[0]-1)*steps]), int(kpts[(sk[0]-1)*steps+1]))
-        pos2 = (int(kpts[(sk[1]-1)*steps]), int(kpts[(sk[1]-1)*steps+1]))
-        if steps == 3:
-            conf1 = kpts[(sk[0]-1)*steps+2]
-            conf2 = kpts[(sk[1]-1)*steps+2]
-            if conf1<0.5 or conf2<0.5:
-                continue
-        if pos1[0]%640 == 0 or pos1[1]%640==0 or pos1[0]<0 or pos1[1]<0:
-            continue
-        if pos2[0] % 640 == 0 or pos2[1] % 640 == 0 or pos2[0]<0 or pos2[1]<0:
-            continue
-        cv2.line(im, pos1, pos2, (int(r), int(g), int(b)), thickness=2)
-
-    return foot_y_coord < head_y_coord
+# COCO keypoint palette and skeleton
+pose_palette = np.array([[255, 128, 0], [255, 153, 51], [255, 178, 102],
+                         [230, 230, 0], [255, 153, 255], [153, 204, 255],
+                         [255, 102, 255], [255, 51, 255], [102, 178, 255],
+                         [51, 153, 255], [255, 153, 153], [255, 102, 102],
+                         [255, 51, 51], [153, 255, 153], [102, 255, 102],
+                         [51, 255, 51], [0, 255, 0], [0, 0, 255], [255, 0, 0],
+                         [255, 255, 255]])
+pose_skeleton = np.array([[16, 14], [14, 12], [17, 15], [15, 13], [12, 13], [6, 12],
+                          [7, 13], [6, 7], [6, 8], [7, 9], [8, 10], [9, 11], [2, 3],
+                          [1, 2], [1, 3], [2, 4], [3, 5], [4, 6], [5, 7]]) - 1  # limb keypoint indices
+pose_limb_color = pose_palette[[9, 9, 9, 9, 7, 7, 7, 0, 0, 0, 0, 0, 16, 16, 16, 16, 16, 16, 16]]
+pose_kpt_color = pose_palette[[16, 16, 16, 16, 16, 0, 0, 0, 0, 0, 0, 9, 9, 9, 9, 9, 9]]
+pose_kpt_sprite = cv2.ellipse2Poly((0, 0), (3, 3), 0, 0, 360, 30)  # outline of a keypoint dot of radius 3
+
+
+def plot_skeletons(im, kpts, steps=3, draw=True):
+    # Plot the skeletons and keypoints of all persons for coco dataset at once, kpts is (n, nkpt * steps) or
+    # (n, nkpt, steps) on any device. Returns the (n,) bed occupancy of the persons, whose lowest head keypoint is below
+    # their highest foot keypoint. draw=False only returns the bed occupancy
+    kpts = kpts.detach().cpu().numpy() if isinstance(kpts, torch.Tensor) else np.asarray(kpts)  # one transfer
+    if kpts.ndim == 2:
+        kpts = kpts.reshape(len(kpts), kpts.shape[1] // steps, steps)
+    kpts = kpts.astype(np.float32, copy=False)
+    n, num_kpts = kpts.shape[:2]
+    xy = kpts[..., :2]
+    conf_ok = kpts[..., 2] >= 0.5 if steps == 3 else np.ones((n, num_kpts), dtype=bool)
+
+    # keypoints on the image border or with a low confidence are not drawn
+    visible = conf_ok & ~((xy[..., 0] % 640 == 0) | (xy[..., 1] % 640 == 0))
+    kid = np.arange(num_kpts)
+    head = visible & (kid <= 6)
+    foot = visible & (kid >= num_kpts - 6) & ~(kid <= 6)
+    head_y_coord = np.where(head, xy[..., 1], 0).max(1, initial=0)
+    foot_y_coord = np.where(foot, xy[..., 1], 640).min(1, initial=640)
+    bed = foot_y_coord < head_y_coord
+    if not draw or not n:
+        return bed
+
+    # keypoint dots, one filled polygon list per color
+    centers = xy.astype(np.int32)
+    for color in np.unique(pose_kpt_color[:num_kpts], axis=0):
+        i = visible & (pose_kpt_color[:num_kpts] == color).all(1)
+        if i.any():
+            cv2.fillPoly(im, list(centers[i][:, None] + pose_kpt_sprite), color.tolist())
+
+    # limbs between two drawn keypoints, one polyline call per color
+    ends = centers[:, pose_skeleton]  # (n, limbs, 2, 2)
+    ok = conf_ok[:, pose_skeleton].all(2) & ~((ends % 640 == 0) | (ends < 0)).any((2, 3))
+    for color in np.unique(pose_limb_color, axis=0):
+        i = ok & (pose_limb_color == color).all(1)
+        if i.any():
+            cv2.polylines(im, list(ends[i]), False, color.tolist(), thickness=2)
+    return bed
+
+
+def plot_skeleton_kpts(im, kpts, steps, orig_shape=None, draw=True):
+    #Plot the skeleton and keypointsfor coco datatset, draw=False only returns the bed occupancy
+    return bool(plot_skeletons(im, kpts[None], steps, draw=draw)[0])
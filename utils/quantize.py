@@ -0,0 +1,141 @@
+# INT8 post-training static quantization of the pose model for CPU inference
+
+import copy
+import io
+import itertools
+import os
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfig, default_per_channel_weight_observer, get_default_qconfig, \
+    get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from models.experimental import attempt_load_deploy, compat_update, deploy_path, save_atomic
+from utils.datasets import LoadImages
+from utils.frame import FramePrep
+from utils.general import box_iou, kpt_oks, non_max_suppression_kpt
+
+
+class Backbone(nn.Module):
+    # The layers of a Model before its detection head. Returns the list of head inputs, see Model.forward_once()
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.model.traced = True  # stop before the head
+
+    def forward(self, x):
+        return self.model.forward_once(x)
+
+
+class QuantizedPose(nn.Module):
+    # The pose model with its backbone and neck quantized to INT8, the keypoint head in fp32. Called like Model, with
+    # the head as model[-1]
+    def __init__(self, backbone, head, names, yaml, stride, backend):
+        super().__init__()
+        self.backbone = backbone
+        self.model = nn.ModuleList([head])
+        self.names = names
+        self.yaml = yaml
+        self.stride = stride
+        self.backend = backend
+
+    def forward(self, x):
+        return self.model[-1](list(self.backbone(x)))
+
+
+def int8_path(weights, backend='x86'):
+    # Path of the INT8 artifact of weights for a quantized backend
+    return deploy_path(weights, precision=f'int8-{backend}')
+
+
+def calibration_frames(source, n=200, stride=64):
+    # Letterboxed BGR frames of the videos or images at source, at most n
+    frame_prep = FramePrep(torch.device('cpu'), stride=stride)
+    return [frame_prep.letterbox(im0)[0] for _, _, im0, _ in itertools.islice(LoadImages(source, stride=stride), n)]
+
+
+def quantize(weights, source, backend='x86', frames=200):
+    # Writes the INT8 artifact of weights: the fused fp32 model is traced with FX up to its detection head, observed
+    # with per-channel weight observers on the convolutions, calibrated on every other frame of source and converted.
+    # The remaining frames are kept for report(). Returns the artifact path, the fp32 model, the INT8 model and the
+    # held out frames
+    assert backend in torch.backends.quantized.supported_engines, f'{backend} is not supported on this host'
+    torch.backends.quantized.engine = backend
+    model = attempt_load_deploy(weights, map_location=torch.device('cpu'))
+    model.model[-1].conf_thres = None
+    images = calibration_frames(source, 2 * frames)
+    calibration, held_out = images[0::2], images[1::2]
+    assert calibration, f'No frames found in {source}'
+    frame_prep = FramePrep(torch.device('cpu'), stride=64)
+
+    qconfig = QConfig(activation=get_default_qconfig(backend).activation, weight=default_per_channel_weight_observer)
+    backbone = Backbone(copy.deepcopy(model)).eval()
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(backend).set_global(qconfig),
+                          (frame_prep.to_tensor(calibration[:1]).clone(),))
+    with torch.no_grad():
+        for im in calibration:  # calibration
+            prepared(frame_prep.to_tensor([im]))
+    example = frame_prep.to_tensor(calibration[:1]).clone()
+    with torch.no_grad():  # TorchScript, as FX modules with quantized layers do not pickle
+        scripted = torch.jit.freeze(torch.jit.trace(convert_fx(prepared).eval(), example))
+    qmodel = QuantizedPose(scripted, copy.deepcopy(model.model[-1]), model.names, model.yaml, model.stride,
+                           backend).eval()
+
+    f = int8_path(weights, backend)
+    buffer = io.BytesIO()
+    torch.jit.save(scripted, buffer)
+    artifact = {'backbone': buffer.getvalue(), 'head': qmodel.model[-1], 'names': model.names, 'yaml': model.yaml,
+                'stride': model.stride, 'backend': backend}
+    save_atomic(lambda tmp: torch.save(artifact, tmp), f)
+    print(f"INT8 model calibrated on {len(calibration)} frames of {source}, saved as {f}, "
+          f"{os.path.getsize(f) / 1E6:.1f}MB")
+    return f, model, qmodel, held_out
+
+
+def attempt_load_int8(weights, backend='x86'):
+    # Loads the INT8 artifact of weights written by quantize()
+    f = int8_path(weights, backend)
+    assert f.exists(), f'{f} not found, run pose-estimate.py --quantize <clip> first'
+    ckpt = torch.load(f, map_location=torch.device('cpu'))
+    torch.backends.quantized.engine = ckpt['backend']
+    backbone = torch.jit.load(io.BytesIO(ckpt['backbone']), map_location=torch.device('cpu'))
+    model = QuantizedPose(backbone, ckpt['head'], ckpt['names'], ckpt['yaml'], ckpt['stride'], ckpt['backend'])
+    compat_update(model.model)
+    return model.eval()
+
+
+@torch.no_grad()
+def report(model, qmodel, images, conf_thres=0.4, iou_thres=0.4):
+    # Prints the latency and accuracy of the INT8 model against the fp32 model on the same frames. Detections are
+    # matched by box IoU > 0.5, accuracy is the share of fp32 detections found and their mean IoU and keypoint OKS
+    frame_prep = FramePrep(torch.device('cpu'), stride=64)
+    nc, nkpt = model.yaml['nc'], model.yaml['nkpt']
+    dt, dets = [0.0, 0.0], [[], []]
+    for im in images:
+        x = frame_prep.to_tensor([im]).clone()
+        for k, m in enumerate((model, qmodel)):
+            t = time.time()
+            pred = non_max_suppression_kpt(m(x)[0], conf_thres, iou_thres, nc=nc, nkpt=nkpt, kpt_label=True)[0]
+            dt[k] += time.time() - t
+            dets[k].append(pred)
+
+    n, found, ious, oks = 0, 0, [], []
+    for a, b in zip(*dets):
+        n += len(a)
+        if not len(a) or not len(b):
+            continue
+        iou, j = box_iou(a[:, :4], b[:, :4]).max(1)
+        matched = iou > 0.5
+        found += int(matched.sum())
+        ious += iou[matched].tolist()
+        area = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+        oks += kpt_oks(a[:, 6:], b[j, 6:], area)[matched].tolist()
+
+    nf = max(len(images), 1)
+    print(f"{'model':>8}{'ms/frame':>10}{'detections':>12}")
+    print(f"{'fp32':>8}{1000 * dt[0] / nf:>10.1f}{n:>12}")
+    print(f"{'int8':>8}{1000 * dt[1] / nf:>10.1f}{sum(len(d) for d in dets[1]):>12}")
+    print(f"speedup {dt[0] / max(dt[1], 1e-9):.2f}x on {len(images)} frames, {found}/{n} fp32 detections found, "
+          f"mean IoU {sum(ious) / max(len(ious), 1):.3f}, mean keypoint OKS {sum(oks) / max(len(oks), 1):.3f}")
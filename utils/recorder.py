@@ -0,0 +1,226 @@
+import collections
+import os
+import threading
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+
+class PrerollBuffer:
+    """A fixed-capacity ring buffer holding the JPEG-compressed frames of the last few seconds, to be written at the
+    start of the next video.
+
+    Each entry holds the capture time, the JPEG bytes (None for a frame that was already written to a video), whether
+    the frame had motion, the number of detections, the bed occupancy, and whether overlays were drawn on it.
+
+    Attributes:
+    seconds: a float representing the length of the buffer in seconds
+    capacity: an integer representing the number of entries, enough for seconds at max_fps
+    quality: an integer representing the JPEG quality of frames encoded for the buffer
+    """
+    def __init__(self, seconds=60, max_fps=10, quality=80):
+        self.seconds = seconds
+        self.capacity = int(seconds * max_fps) + 1
+        self.quality = quality
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.entries = [None] * self.capacity
+        self.start = 0  # index of the oldest entry
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _pop(self):
+        self.entries[self.start] = None
+        self.start = (self.start + 1) % self.capacity
+        self.size -= 1
+
+    def expire(self, t):
+        """
+        Drops the entries older than seconds before time t.
+        """
+        while self.size and t - self.times[self.start] > self.seconds:
+            self._pop()
+
+    def encode(self, im):
+        flag, jpeg = cv2.imencode(".jpg", im, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return jpeg if flag else None
+
+    def append(self, t, jpeg, is_motion, num_detections=0, bed_occupied=False, rendered=True):
+        self.expire(t)
+        if self.size == self.capacity:
+            self._pop()
+        i = (self.start + self.size) % self.capacity
+        self.times[i] = t
+        self.entries[i] = (jpeg, bool(is_motion), num_detections, bed_occupied, rendered)
+        self.size += 1
+
+    def drain(self):
+        """
+        Returns the (time, jpeg, is_motion, num_detections, bed_occupied, rendered) entries that were not written yet,
+        oldest first, and empties the buffer.
+        """
+        out = []
+        while self.size:
+            t, entry = self.times[self.start], self.entries[self.start]
+            if entry[0] is not None:
+                out.append((t, *entry))
+            self._pop()
+        return out
+
+
+class VideoRecorder:
+    """Writes the event videos of one camera from its own thread, fed through a queue, so neither video writing nor
+    the pre-roll flush at the start of an event ever blocks the detection path.
+
+    The recorder owns the whole video lifecycle. A video is opened on the first motion frame, starting with the
+    frames of the pre-roll buffer. It stays open until postroll_seconds pass without motion, and it is split into a
+    new file every segment_seconds. Frames are written at fps and repeated when they were captured at a lower rate,
+    so the videos play in real time. The queue holds raw frames, so it is bounded by max_bytes of frame data rather
+    than by a number of frames. When it is full, frames from a live camera are dropped, while a blocking recorder
+    makes the caller wait, so recordings of offline sources keep every frame.
+
+    Attributes:
+    directory: the directory the videos are written to
+    prefix: a string prepended to the file names
+    fps: a float representing the frame rate of the videos
+    size: a (width, height) tuple of the frames
+    postroll_seconds: a float representing how long a video continues after the last motion
+    segment_seconds: a float representing the longest duration of one video file
+    annotate: called as annotate(im, t, is_motion, num_detections, bed_occupied) on pre-roll frames that were not
+    rendered, or None
+    histogram: a telemetry Histogram observing the seconds spent on every frame, or None
+    recording: a boolean representing whether a video is open
+    max_bytes: an integer representing the largest size of the queued frames and JPEGs
+    queued_bytes: an integer representing the size of the queued frames and JPEGs
+    block: a boolean representing whether submit() waits for room instead of dropping the frame
+    dropped: an integer counting the frames discarded because the queue was full
+    """
+    def __init__(self, directory='output_videos', prefix='', fps=10, size=(640, 640), preroll_seconds=60,
+                 postroll_seconds=60, segment_seconds=1800, annotate=None, max_bytes=128 * 2 ** 20,
+                 block=False, histogram=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.fps = fps
+        self.size = size
+        self.postroll_seconds = postroll_seconds
+        self.segment_seconds = segment_seconds
+        self.annotate = annotate
+        self.histogram = histogram
+        self.preroll = PrerollBuffer(preroll_seconds, fps)
+        self.recording = False
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+        self.block = block
+        self.dropped = 0
+        self.out = None
+        self.last_motion = None
+        self.video_start_time = None
+        self.video_time = None
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._work, name=f'recorder-{prefix}', daemon=True)
+        self._thread.start()
+
+    def submit(self, t, im, jpeg, is_motion, num_detections=0, bed_occupied=False, rendered=True):
+        """
+        Queues a frame captured at time t. jpeg is the frame already encoded for the stream, or None. When the queue is
+        full, the frame is dropped, or with block, waits for room. An empty queue always takes the frame.
+        """
+        nbytes = im.nbytes + (jpeg.nbytes if jpeg is not None else 0)
+        with self._cond:
+            while self.block and self._items and self.queued_bytes + nbytes > self.max_bytes:
+                self._cond.wait()
+            if self._items and self.queued_bytes + nbytes > self.max_bytes:
+                self.dropped += 1
+                return
+            self._items.append((nbytes, (t, im, jpeg, bool(is_motion), num_detections, bed_occupied, rendered)))
+            self.queued_bytes += nbytes
+            self._cond.notify_all()
+
+    @property
+    def queue_depth(self):
+        # frames waiting to be written
+        return len(self._items)
+
+    def close(self):
+        """
+        Writes the queued frames, releases the open video and stops the thread.
+        """
+        with self._cond:
+            self._items.append((0, None))
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _work(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._items:
+                        self._cond.wait()
+                    nbytes, item = self._items.popleft()
+                    self.queued_bytes -= nbytes
+                    self._cond.notify_all()
+                if item is None:
+                    break
+                start = time.monotonic()
+                self._handle(*item)
+                if self.histogram is not None:
+                    self.histogram.observe(time.monotonic() - start)
+        finally:
+            if self.out is not None:
+                self.out.release()
+                self.out = None
+            self.recording = False
+
+    def _handle(self, t, im, jpeg, is_motion, num_detections, bed_occupied, rendered):
+        if is_motion:
+            self.last_motion = t
+
+        written = False
+        if self.out is None and is_motion:
+            # new event, starting with the pre-roll
+            buffered = self.preroll.drain()
+            self._open(t, buffered[0][0] if buffered else t)
+            for bt, buffered_jpeg, buffered_motion, buffered_detections, buffered_bed, buffered_rendered in buffered:
+                buffered_im = cv2.imdecode(buffered_jpeg, cv2.IMREAD_COLOR)
+                if not buffered_rendered and self.annotate is not None:
+                    self.annotate(buffered_im, bt, buffered_motion, buffered_detections, buffered_bed)
+                self._write(buffered_im, bt)
+            self._write(im, t)
+            written = True
+        elif self.out is not None and t - self.last_motion <= self.postroll_seconds:
+            self._write(im, t)
+            written = True
+        elif self.out is not None:
+            # post-roll is over
+            self.out.release()
+            self.out = None
+            self.recording = False
+
+        # break videos into segments
+        if self.out is not None and t - self.video_start_time >= self.segment_seconds:
+            self.out.release()
+            self._open(t, t)
+            print("Back up Video")
+
+        # Frames already in a video are kept for their motion flag only
+        if not written and jpeg is None:
+            jpeg = self.preroll.encode(im)
+        self.preroll.append(t, None if written else jpeg, is_motion, num_detections, bed_occupied, rendered)
+
+    def _open(self, t, start_time):
+        curr_time = datetime.fromtimestamp(t).strftime("%Y-%m-%d %H-%M-%S")
+        self.out = cv2.VideoWriter(os.path.join(self.directory, f"{self.prefix}{curr_time}.mp4"),
+                                   cv2.VideoWriter_fourcc(*'mp4v'), self.fps, self.size)
+        self.video_start_time = start_time
+        self.video_time = start_time
+        self.recording = True
+
+    def _write(self, im, t):
+        n = max(round((t - self.video_time) * self.fps), 1)
+        for _ in range(n):
+            self.out.write(im)
+        self.video_time += n / self.fps
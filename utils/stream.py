@@ -0,0 +1,59 @@
+import threading
+
+
+class FrameHub:
+    """Broadcasts encoded frames to any number of stream clients. The producer publishes every frame once with a
+    sequence number. Each client blocks until a newer frame exists, and a client that falls behind skips straight to
+    the latest frame instead of queueing the ones it missed.
+
+    Attributes:
+    frame: the latest published frame, or None before the first one
+    seq: an integer representing the sequence number of the latest frame
+    viewers: an integer representing the number of connected clients
+    """
+    def __init__(self):
+        self.frame = None
+        self.seq = 0
+        self.viewers = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def publish(self, frame):
+        with self._cond:
+            self.frame = frame
+            self.seq += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait(self, seq):
+        """
+        Blocks until a frame newer than seq is published. Returns the latest (seq, frame) pair, or (seq, None) once
+        the hub is closed.
+        """
+        with self._cond:
+            while self.seq <= seq and not self.closed:
+                self._cond.wait()
+            if self.seq <= seq:
+                return seq, None
+            return self.seq, self.frame
+
+    def subscribe(self):
+        """
+        Yields every newer frame until the hub is closed. Meant to be the body of a streaming response.
+        """
+        with self._cond:
+            self.viewers += 1
+        try:
+            seq = 0
+            while True:
+                seq, frame = self.wait(seq)
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            with self._cond:
+                self.viewers -= 1
@@ -0,0 +1,150 @@
+# Runtime telemetry: per stage latency histograms and counters, exposed in the Prometheus text format
+
+import bisect
+import math
+import time
+
+descriptions = {
+    'pose_stage_seconds': 'Seconds spent on one item in each stage of the pipeline',
+    'pose_latency_seconds': 'Seconds from the capture of a frame to the end of its encoding',
+    'pose_frames_total': 'Frames captured',
+    'pose_motion_frames_total': 'Frames with motion',
+    'pose_inferences_total': 'Calls of the YOLO model',
+    'pose_inference_frames_total': 'Frames that went through the YOLO model',
+    'pose_queue_depth': 'Items waiting in the inbox of each stage',
+    'pose_dropped_total': 'Items discarded at the inbox of each stage because the stage was busy',
+    'pose_recorder_queue_depth': 'Frames waiting to be written by the video recorder',
+    'pose_recorder_dropped_total': 'Frames discarded because the video recorder queue was full',
+    'pose_capture_fps': 'Current target capture rate',
+}
+
+
+class Histogram:
+    """A latency histogram with fixed, logarithmically spaced buckets from 10us to 100s, about 26% apart. Every
+    histogram has a single writer thread, so observe() takes no lock. A reader may miss an observation that is in
+    progress, which does not matter for monitoring.
+
+    Attributes:
+    counts: a list of integers, the number of observations per bucket, the last one for anything above the bounds
+    sum: a float representing the total of the observations in seconds
+    """
+    bounds = [1e-5 * 10 ** (i / 10) for i in range(71)]  # upper bucket bounds in seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        """
+        Returns the quantiles qs of the observations, interpolated within their bucket, and the number of
+        observations. The quantiles are nan without observations.
+        """
+        counts = list(self.counts)  # snapshot
+        n = sum(counts)
+        out = []
+        for q in qs:
+            rank, cumulative = q * n, 0
+            for i, c in enumerate(counts):
+                if c and cumulative + c >= rank:
+                    lower = self.bounds[i - 1] if i else 0.0
+                    upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                    out.append(lower + (upper - lower) * (rank - cumulative) / c)
+                    break
+                cumulative += c
+            else:
+                out.append(math.nan)
+        return out, n
+
+
+class Timer:
+    # Context manager observing the monotonic time spent in its block
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class Telemetry:
+    """The histograms and counters of one process, keyed by metric name and labels, in the order they are passed. Each
+    key is only written by one thread, e.g. by using the camera as a label for per camera work, so no locks are
+    needed.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(labels.items()))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms.setdefault(key, Histogram())
+        return h
+
+    def time(self, stage, **labels):
+        """
+        Returns a Timer for a block of work of stage, as in "with telemetry.time('render', cam=0):".
+        """
+        return Timer(self.histogram('pose_stage_seconds', stage=stage, **labels))
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def prometheus(self, samples=()):
+        """
+        Returns the histograms as summaries with their p50, p95 and p99, the counters, and the extra samples, in the
+        Prometheus text exposition format. samples are (name, type, labels, value) tuples for gauges and counters kept
+        elsewhere.
+        """
+        families = {}
+        for (name, labels), h in sorted(self.histograms.items()):
+            (p50, p95, p99), n = h.quantiles()
+            lines = families.setdefault((name, 'summary'), [])
+            for q, v in (('0.5', p50), ('0.95', p95), ('0.99', p99)):
+                lines.append(f'{name}{format_labels(labels + (("quantile", q),))} {v:.6g}')
+            lines.append(f'{name}_sum{format_labels(labels)} {h.sum:.6g}')
+            lines.append(f'{name}_count{format_labels(labels)} {n}')
+        for (name, labels), v in sorted(self.counters.items()):
+            families.setdefault((name, 'counter'), []).append(f'{name}{format_labels(labels)} {v}')
+        for name, kind, labels, v in samples:
+            families.setdefault((name, kind), []).append(f'{name}{format_labels(tuple(labels.items()))} {v:.6g}')
+
+        out = []
+        for (name, kind), lines in families.items():
+            out.append(f'# HELP {name} {descriptions.get(name, name)}')
+            out.append(f'# TYPE {name} {kind}')
+            out += lines
+        return '\n'.join(out) + '\n'
+
+    def summary(self):
+        # p50, p95 and p99 of every histogram in milliseconds
+        print(f"{'timer':>32}{'count':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            (p50, p95, p99), n = h.quantiles()
+            labels = dict(labels)
+            label = ' '.join([labels.pop('stage', name)] + [f'{k}={v}' for k, v in labels.items()])
+            print(f"{label:>32}{n:>10}{1000 * p50:>10.2f}{1000 * p95:>10.2f}{1000 * p99:>10.2f}")
+
+
+def format_labels(labels):
+    # {k="v",...} of a sequence of (key, value) pairs, empty without labels
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+telemetry = Telemetry()  # of this process
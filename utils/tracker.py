@@ -0,0 +1,143 @@
+# Multi-person pose tracking with keyframe inference
+
+import cv2
+import torch
+from scipy.optimize import linear_sum_assignment
+
+from utils.general import box_iou, kpt_oks
+
+
+class PoseTracker:
+    """Gives the poses of one camera persistent track ids, and fills in the frames between keyframes without the
+    model.
+
+    On a keyframe, the detections of non_max_suppression_kpt are matched one-to-one with the current tracks by box IoU,
+    or by keypoint OKS with match='oks'. Matched detections keep their track id, unmatched detections start new tracks,
+    and tracks left unmatched for max_age keyframes are dropped. Between keyframes, the keypoints of every track are
+    moved by pyramidal Lucas-Kanade optical flow on the grayscale frames, and each box follows the median motion of
+    its visible keypoints. A track's quality is 1 on a keyframe, and every propagated frame multiplies it by decay and
+    by the share of its visible keypoints that the flow found again.
+
+    A keyframe is due every keyframe_interval motion frames, on the first motion frame after a still one, when the
+    motion area grows or shrinks by more than area_jump times since the last keyframe, when there is no track, and when
+    the quality of any track falls below min_quality.
+
+    Attributes:
+    keyframe_interval: an integer representing the number of motion frames per model call, 1 to run it on all of them
+    match: 'iou' or 'oks', the similarity used to match detections with tracks
+    match_thres: a float representing the lowest similarity of a match
+    tracks: a (n, 6 + 3 * nkpt) tensor of the tracked poses on the CPU, rows like the output of
+    non_max_suppression_kpt
+    ids: a (n,) int64 tensor of their track ids
+    quality: a (n,) tensor of their quality
+    """
+    def __init__(self, keyframe_interval=1, match='iou', match_thres=0.3, max_age=3, decay=0.95, min_quality=0.5,
+                 area_jump=2.0, kpt_thres=0.5):
+        assert match in ('iou', 'oks'), f'unknown track matching {match}'
+        self.keyframe_interval = keyframe_interval
+        self.match = match
+        self.match_thres = match_thres
+        self.max_age = max_age
+        self.decay = decay
+        self.min_quality = min_quality
+        self.area_jump = area_jump
+        self.kpt_thres = kpt_thres
+        self.tracks = torch.zeros((0, 57))
+        self.ids = torch.zeros(0, dtype=torch.int64)
+        self.quality = torch.zeros(0)
+        self.age = torch.zeros(0, dtype=torch.int64)  # keyframes since the last match
+        self.visible = torch.zeros(0, dtype=torch.bool)  # matched on the last keyframe, the first rows of tracks
+        self.next_id = 1
+        self.prev_grey = None
+        self.since_keyframe = 0
+        self.keyframe_area = 0
+        self.stale = True  # the tracks are not usable for propagation
+
+    def idle(self):
+        """
+        Marks a frame without motion, so the model runs on the next motion frame.
+        """
+        self.stale = True
+
+    def schedule(self, motion_area):
+        """
+        Returns whether the model has to run on the next frame, which has motion_area foreground pixels. Called once
+        per motion frame, before its keyframe or propagate call. The frames of one batch can be scheduled before the
+        model runs on any of them.
+        """
+        jump = max(motion_area, 1) / max(self.keyframe_area, 1)
+        keyframe = (self.stale or self.since_keyframe + 1 >= self.keyframe_interval or not self.visible.any()
+                    or max(jump, 1 / jump) > self.area_jump or bool((self.quality < self.min_quality).any()))
+        if keyframe:
+            self.since_keyframe, self.keyframe_area, self.stale = 0, motion_area, False
+        else:
+            self.since_keyframe += 1
+        return keyframe
+
+    def keyframe(self, pose, grey):
+        """
+        Matches the detections pose of the frame with grey frame grey with the tracks. Returns their track ids.
+        """
+        pose = pose.detach().float().cpu()
+        n, m = len(pose), len(self.tracks)
+        det_ids = torch.full((n,), -1, dtype=torch.int64)
+        matched = torch.zeros(m, dtype=torch.bool)
+        if n and m:
+            if self.match == 'oks':
+                area = (self.tracks[:, 2] - self.tracks[:, 0]) * (self.tracks[:, 3] - self.tracks[:, 1])
+                similarity = kpt_oks(self.tracks[:, None, 6:], pose[None, :, 6:], area[:, None],
+                                     kpt_thres=self.kpt_thres)
+            else:
+                similarity = box_iou(self.tracks[:, :4], pose[:, :4])
+            rows, cols = linear_sum_assignment(similarity.numpy(), maximize=True)
+            good = similarity[rows, cols] >= self.match_thres
+            rows, cols = torch.from_numpy(rows[good.numpy()]), torch.from_numpy(cols[good.numpy()])
+            det_ids[cols] = self.ids[rows]
+            matched[rows] = True
+
+        # new tracks for the unmatched detections
+        new = det_ids < 0
+        det_ids[new] = torch.arange(self.next_id, self.next_id + int(new.sum()))
+        self.next_id += int(new.sum())
+
+        # unmatched tracks are kept for max_age keyframes, without being drawn
+        age = self.age[~matched] + 1
+        keep = age < self.max_age
+        self.tracks = torch.cat((pose, self.tracks[~matched][keep])) if m else pose
+        self.ids = torch.cat((det_ids, self.ids[~matched][keep]))
+        self.age = torch.cat((torch.zeros(n, dtype=torch.int64), age[keep]))
+        self.quality = torch.ones(len(self.tracks))
+        self.visible = torch.arange(len(self.tracks)) < n
+        self.prev_grey = grey
+        return det_ids
+
+    def propagate(self, grey):
+        """
+        Moves the tracks from the previous frame to grey frame grey. Returns the tracked poses, rows like the output
+        of non_max_suppression_kpt with the confidence scaled by the track quality, and their track ids.
+        """
+        n = int(self.visible.sum())
+        tracks = self.tracks[:n]
+        if n:
+            kpts = tracks[:, 6:].view(n, -1, 3)
+            p0 = kpts[..., :2].reshape(-1, 1, 2).contiguous().numpy()
+            p1, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_grey, grey, p0, None, winSize=(31, 31), maxLevel=3)
+            found = torch.from_numpy(status.reshape(n, -1).astype(bool))
+            flow = torch.from_numpy(p1 - p0).view(n, -1, 2)
+            visible = kpts[..., 2] > self.kpt_thres
+
+            # boxes and lost keypoints follow the median motion of the visible keypoints found again
+            shift = torch.zeros(n, 2)
+            for i in range(n):
+                ok = found[i] & visible[i]
+                if ok.any():
+                    shift[i] = flow[i][ok].median(0).values
+            kpts[..., :2] += torch.where(found[..., None], flow, shift[:, None])
+            tracks[:, :4] += shift.repeat(1, 2)
+
+            share = (found & visible).sum(1) / visible.sum(1).clamp(min=1)
+            self.quality[:n] *= self.decay * share
+        self.prev_grey = grey
+        pose = tracks.clone()
+        pose[:, 4] *= self.quality[:n]
+        return pose, self.ids[:n]